@@ -23,10 +23,15 @@ from hopper.utils.logger import *
 from hopper.utils.bitbake.BitBakeTask import *
 import hopper.utils.bitbake.mirrors
 import hopper.utils.bitbake.config
+import hopper.utils.bitbake.LayerDependencies
+import hopper.utils.bitbake.fingerprint
 
 import hopper.source.fetcher
+import hopper.source.lockfile
 
 import hopper.utils.tasks
+import hopper.utils.process
+import hopper.utils.git.maintenance
 from hopper.utils.oe.BuildTools import *
 
 import shutil
@@ -49,20 +54,51 @@ class BuildTask(hopper.utils.tasks.TaskBase):
 		self.subshell = False
 		self.updateMirror = False
 		self.overwriteconfig = True
+		self.forceupdate = False
+		self.fetchjobs = None
+		self.fetchoptions = hopper.source.fetcher.LayerFetchOptions()
+		# write a lockfile of the layers once fetched
+		self.writelock = None
+		# maintain the repositories (rate limited) once the build is complete
+		self.maintain = False
+		# handling of the layer dependencies ("warn", "check", "add" or "ignore")
+		self.layerdepends = "warn"
+		# skip bitbake if nothing changed since the last successful build
+		self.skipunchanged = False
 
 	def execute(self, handler = None):
 		if not hopper.utils.tasks.TaskBase.execute(self, handler):
 			return False
 
-		self.tasks.append(BuildToolsTask(self.environment))
-		self.tasks += hopper.source.fetcher.generateLayerFetchTasks(self.environment, self.config.layers)
+		# mirrors are refreshed at most once per build
+		self.environment = self.environment.clone()
+		self.environment.refreshedmirrors = set()
 
-		# execute tasks
-		for i in self.tasks:
-			i.execute(handler)
+		# the fetch and configuration are skipped if nothing changed since the last successful build
+		fingerprint = hopper.utils.bitbake.fingerprint.ConfigurationFingerprint(self.environment, self.config)
+		unchanged = False
+		if not self.subshell:
+			unchanged = fingerprint.matches(fingerprint.calculate(self.forceupdate, self.fetchoptions), self.targets)
+
+		if unchanged:
+			self.environment.log("Layers and configuration are unchanged since the last successful build, skipping fetch and configuration")
+		else:
+			fingerprint.clear()
+			self.fetch(handler)
+			self.__resolveDependencies__(handler)
+
+		if self.writelock:
+			self.environment.log("Writing layer lockfile '%s'" % self.writelock)
+			hopper.source.lockfile.LayerLock.write(self.writelock, self.environment, self.config.layers)
+
+		if unchanged and self.skipunchanged:
+			if fingerprint.isClean():
+				self.environment.log("Nothing changed since the last successful build, skipping BitBake")
+				return (0, None)
+			self.environment.log("Layers have local changes, not skipping BitBake")
 
 		# Build
-		result = self.__build__()
+		result = self.__build__(generate = not unchanged)
 		if result:
 			if result[1]:
 				for i in result[1].warnings:
@@ -73,14 +109,62 @@ class BuildTask(hopper.utils.tasks.TaskBase):
 			if result[0] != 0:
 				return result
 
+		if not self.subshell:
+			fingerprint.write(fingerprint.calculate(self.forceupdate, self.fetchoptions), self.targets)
+
 		if self.updateMirror and self.environment.getDownloadMirror():
 			if not hopper.utils.bitbake.mirrors.SourceMirror.updateMirror(self.environment,
 					self.environment.getDownloadMirror()):
 				raise Exception("Failed to update download mirror")
 
+		if self.maintain:
+			try:
+				hopper.utils.git.maintenance.MaintenanceTask(self.environment).execute(handler)
+			except Exception as e:
+				self.environment.warning("Repository maintenance failed: %s" % e)
+
 		return result
 
-	def __build__(self):
+	# Prepare the build tools and fetch the layer repositories
+	def fetch(self, handler = None):
+		buildtools = BuildToolsTask(self.environment)
+		fetchenvironment = self.environment
+		if not BuildToolsHelper.isInstalled(self.environment.getWorkingToolsPath()):
+			if hopper.utils.process.ProcessHelper.searchPath("git"):
+				# the build tools are installed concurrently, use the host git until they are ready
+				fetchenvironment = self.environment.clone()
+				fetchenvironment.allowbuildtools = False
+			else:
+				buildtools.execute(handler)
+				buildtools = None
+
+		self.tasks = []
+		if buildtools:
+			self.tasks.append(buildtools)
+		self.tasks += hopper.source.fetcher.generateLayerFetchTasks(fetchenvironment, self.config.layers,
+				self.forceupdate, self.fetchoptions)
+
+		# execute tasks
+		executor = hopper.utils.tasks.TaskExecutor(self.environment, self.fetchjobs)
+		for i in self.tasks:
+			executor.add(i)
+		executor.execute(handler)
+
+	# Check the dependencies of the fetched layers before bitbake parses them, missing
+	# layers are added (and fetched) if enabled
+	def __resolveDependencies__(self, handler = None):
+		if self.layerdepends == "ignore":
+			return
+
+		resolver = hopper.utils.bitbake.LayerDependencies.LayerDependencyResolver(self.environment, self.config.layers)
+		while True:
+			added = resolver.resolve(addmissing = (self.layerdepends == "add"),
+					fatal = (self.layerdepends in ["check", "add"]))
+			if len(added) == 0:
+				break
+			self.fetch(handler)
+
+	def __build__(self, generate = True):
 		if self.subshell:
 			self.environment.log("Preparing subshell")
 			if "SHELL" in os.environ:
@@ -96,6 +180,7 @@ class BuildTask(hopper.utils.tasks.TaskBase):
 			self.environment.log("    * targets = %s" % ",".join(self.targets))
 
 		step.overwrite = self.overwriteconfig
+		step.generate = generate
 		step.sublogger = self.outputlogger
 
 		return step.execute()
@@ -18,6 +18,8 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import os
+
 from hopper.utils.logger import *
 
 from CommandHopperBase import *
@@ -27,6 +29,7 @@ import hopper.utils.bitbake.config
 import hopper.source.meta
 import hopper.source.fetcher
 import hopper.source.LayerDefaultRemotes
+import hopper.source.lockfile
 
 from BuildTask import *
 
@@ -45,6 +48,29 @@ class CommandBake(CommandHopperBase):
 				"Ther version specifier accepts valid git refs '<branch>[:<commit-id>]'." +
 				"Alternatively the 'local' version can be used to specify the use of a repository/layer, this creates a symlink to the local path instead of performing a checkout.\n\n" +
 				"If the version is not specified it will use the version of the repository or the default version.")
+	lock = hopper.utils.args.ValueOption(
+			None, "lock",
+			default = None,
+			description = "Use the layers and commits recorded in the specified lockfile (see --write-lock).\n" +
+				"(The layer options and the layer index are not used)")
+	writelock = hopper.utils.args.ValueOption(
+			None, "write-lock",
+			default = None,
+			description = "Once the layers are fetched, record the layers and the commits their refs resolved to in the specified lockfile.")
+	layerindex = hopper.utils.args.ValueOption(
+			None, "layer-index",
+			default = None,
+			description = "The base url of the layer index REST API used to find layers which are not fully specified " +
+				"(a 'file://' directory of recorded responses can be used offline).\n" +
+				"(This can be defined via the environment variable HOPPER_LAYER_INDEX.)")
+	layerdepends = hopper.utils.args.ValueOption(
+			None, "layer-depends",
+			default = "warn",
+			description = "How the dependencies (LAYERDEPENDS/LAYERSERIES_COMPAT) of the fetched layers are handled before starting BitBake.\n\n" +
+				"'warn' reports unsatisfied dependencies as warnings, 'check' fails if a dependency is not satisfied, " +
+				"'add' adds the layers providing missing dependencies (found via the layer index) and fails for any other problem " +
+				"and 'ignore' leaves the checks to BitBake.\n" +
+				"(The layer.conf files are not fully evaluated, values which cannot be determined are not checked)")
 	version = hopper.utils.args.ValueOption(
 			"v", "version",
 			default = "master",
@@ -54,6 +80,70 @@ class CommandBake(CommandHopperBase):
 			default = False,
 			description = "Forces the update of repositories, ensuring that the local cache and clone are at the newest version.")
 
+	fetchtags = hopper.utils.args.BooleanOption(
+			None, "fetch-tags",
+			default = False,
+			description = "When updating repositories also fetch all tags from the remote.\n" +
+				"(By default only the requested ref is fetched)")
+	clonedepth = hopper.utils.args.ValueOption(
+			None, "clone-depth",
+			default = None,
+			description = "Create shallow clones of the layer repositories, truncating the history to the specified number of commits.\n\n" +
+				"Refs/commits which are not part of the shallow history are fetched on demand.")
+	clonefilter = hopper.utils.args.ValueOption(
+			None, "clone-filter",
+			default = None,
+			description = "Create partial clones of the layer repositories using the specified object filter (e.g. 'blob:none' or 'tree:0').\n" +
+				"(Missing objects are fetched by git when required)")
+	worktrees = hopper.utils.args.BooleanOption(
+			None, "worktrees",
+			default = False,
+			description = "Create the layer repositories as worktrees of the repository mirror instead of as clones.\n\n" +
+				"All build directories on the host share the objects of the mirror, so new build directories need almost no disk space or clone time. " +
+				"(Requires a writable mirror, see --mirror)")
+	sparse = hopper.utils.args.BooleanOption(
+			None, "sparse",
+			default = False,
+			description = "Only checkout the layer directories (and the root 'conf' and 'scripts' directories) of repositories which are used by the build.\n" +
+				"(Repositories where the entire repository is a layer are always fully checked out)")
+	untrackedcache = hopper.utils.args.BooleanOption(
+			None, "untracked-cache",
+			default = False,
+			description = "Enable git's untracked cache on the layer repositories, speeding up the checks for local changes.")
+	fsmonitor = hopper.utils.args.ValueOption(
+			None, "fsmonitor",
+			default = None,
+			description = "Set 'core.fsmonitor' of the layer repositories to the specified value (e.g. 'true' or the path to a fsmonitor hook), " +
+				"allowing the checks for local changes to avoid scanning the working tree.")
+	bundles = hopper.utils.args.ValueOption(
+			None, "bundles",
+			default = None,
+			description = "A directory of git bundles (see the 'bundle' command) which are used to clone and update the layer repositories before fetching from the remotes.\n" +
+				"(This can be defined via the environment variable HOPPER_BUNDLES.)")
+	refcachettl = hopper.utils.args.ValueOption(
+			None, "ref-cache-ttl",
+			default = None,
+			description = "When updating repositories, trust the commit a remote ref was last resolved to for the specified number of seconds instead of querying the remote.\n\n" +
+				"A value of 0 always queries the remote. " +
+				"(This can be defined via the environment variable HOPPER_REF_CACHE_TTL.)")
+	fetchjobs = hopper.utils.args.ValueOption(
+			None, "fetch-jobs",
+			default = None,
+			description = "The maximum number of repositories to fetch concurrently.\n" +
+				"(Default is to use the thread limit)")
+
+	skipunchanged = hopper.utils.args.BooleanOption(
+			None, "skip-unchanged",
+			default = False,
+			description = "Skip BitBake if the layer commits, configuration, generated confs, BitBake version and targets are unchanged since the last successful build.\n" +
+				"(The fetch and configuration steps are always skipped in that case)")
+
+	maintain = hopper.utils.args.BooleanOption(
+			None, "maintain",
+			default = False,
+			description = "Once the build is complete, maintain (repack, pack refs, write commit-graphs and prune) the layer repositories and mirrors.\n" +
+				"(Each repository is maintained at most once a day, see the 'maintain' command)")
+
 	# Configuration
 	distro = hopper.utils.args.ValueOption(
 			None, "distro",
@@ -118,12 +208,21 @@ class CommandBake(CommandHopperBase):
 	def __init__(self):
 		CommandHopperBase.__init__(self)
 
-	def getConfiguration(self):
+	def getConfiguration(self, metalayers = None):
 		# generate layer data
-		metalayers = hopper.source.meta.LayerCollection(self.version)
-		metalayers.addIndex(hopper.source.LayerDefaultRemotes.OELayerIndexCache.getCache())
-		metalayers.parse(self.layers)
-		metalayers.validate()
+		if metalayers == None and self.lock:
+			metalayers = hopper.source.lockfile.LayerLock.read(self.lock, self.version)
+		elif metalayers == None:
+			layerindex = CommandHopperBase.valueOrEnvironment(self.layerindex, "HOPPER_LAYER_INDEX")
+			if layerindex:
+				hopper.source.LayerDefaultRemotes.OELayerIndexCache.baseurl = layerindex
+			metalayers = hopper.source.meta.LayerCollection(self.version)
+			# the index is searched for the layers of the requested version (series) first
+			branches = hopper.source.LayerDefaultRemotes.OELayerIndexCache.getBranches(self.version)
+			metalayers.addIndexProvider(lambda: hopper.source.LayerDefaultRemotes.OELayerIndexCache.getCache(branches),
+					hopper.source.LayerDefaultRemotes.OELayerIndexCache.findDefault)
+			metalayers.parse(self.layers)
+			metalayers.validate()
 
 		# Configuration
 		configuration = hopper.utils.bitbake.config.Configuration(metalayers)
@@ -137,15 +236,44 @@ class CommandBake(CommandHopperBase):
 
 		return configuration
 
-	def execute(self, handler = None):
-		CommandHopperBase.execute(self)
-
+	def getBuildTask(self, configuration):
 		# TODO: map the helper args to override
-		buildtask = BuildTask(self.environment, self.getConfiguration())
+		buildtask = BuildTask(self.environment, configuration)
 		buildtask.subshell = self.subshell
 		buildtask.updateMirror = self.updateMirror
 		buildtask.overwriteconfig = not(self.preserveconfig)
+		buildtask.forceupdate = self.forceupdate
+		if self.fetchjobs and (not self.fetchjobs.isdigit() or int(self.fetchjobs) < 1):
+			raise Exception("Invalid fetch jobs '%s' (expected a positive number)" % self.fetchjobs)
+		buildtask.fetchjobs = int(self.fetchjobs) if self.fetchjobs else None
+		buildtask.fetchoptions.tags = self.fetchtags
+		buildtask.fetchoptions.worktree = self.worktrees
+		buildtask.fetchoptions.sparse = self.sparse
+		if self.clonedepth and (not self.clonedepth.isdigit() or int(self.clonedepth) < 1):
+			raise Exception("Invalid clone depth '%s' (expected a positive number)" % self.clonedepth)
+		buildtask.fetchoptions.depth = int(self.clonedepth) if self.clonedepth else None
+		buildtask.fetchoptions.filter = self.clonefilter
+		buildtask.fetchoptions.untrackedcache = self.untrackedcache
+		bundles = CommandHopperBase.valueOrEnvironment(self.bundles, "HOPPER_BUNDLES")
+		buildtask.fetchoptions.bundles = os.path.abspath(bundles) if bundles else None
+		buildtask.fetchoptions.fsmonitor = self.fsmonitor
+		refcachettl = CommandHopperBase.valueOrEnvironment(self.refcachettl, "HOPPER_REF_CACHE_TTL")
+		if refcachettl and not refcachettl.isdigit():
+			raise Exception("Invalid ref cache ttl '%s' (expected a number of seconds)" % refcachettl)
+		buildtask.fetchoptions.refcachettl = int(refcachettl) if refcachettl else None
+		buildtask.maintain = self.maintain
+		if self.layerdepends not in ["warn", "check", "add", "ignore"]:
+			raise Exception("Invalid layer dependency mode '%s' (expected 'warn', 'check', 'add' or 'ignore')" % self.layerdepends)
+		buildtask.layerdepends = self.layerdepends
+		buildtask.skipunchanged = self.skipunchanged
+		buildtask.writelock = os.path.abspath(self.writelock) if self.writelock else None
 		buildtask.targets = self.targets
+		return buildtask
+
+	def execute(self, handler = None):
+		CommandHopperBase.execute(self)
+
+		buildtask = self.getBuildTask(self.getConfiguration())
 
 		# default to subshell mode if no targets
 		if (not self.targets or len(self.targets) <= 0) and not (self.subshell):
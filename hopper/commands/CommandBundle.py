@@ -0,0 +1,77 @@
+# Copyright (c) 2015 Xilinx Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+
+from hopper.utils.logger import *
+
+from CommandBake import *
+import hopper.utils.args
+import hopper.utils.git.repo
+import hopper.utils.git.bundle
+import hopper.source.meta
+
+class CommandBundle(CommandBake):
+	CommandName = "bundle"
+
+	output = hopper.utils.args.ValueOption(
+			"o", "output",
+			default = "bundles",
+			description = "The directory to write the bundles and manifest to.")
+	since = hopper.utils.args.ValueOption(
+			None, "since",
+			default = None,
+			description = "The manifest of a previous export, only the objects which are new since that export are bundled.")
+
+	def __init__(self):
+		CommandBake.__init__(self)
+
+	def execute(self, handler = None):
+		CommandHopperBase.execute(self)
+
+		configuration = self.getConfiguration()
+
+		# bring the layer repositories to the requested refs
+		buildtask = self.getBuildTask(configuration)
+		buildtask.fetch(handler)
+
+		previous = {}
+		if self.since:
+			previous = hopper.utils.git.bundle.BundleStore.readManifest(self.since).get("repositories", {})
+
+		store = hopper.utils.git.bundle.BundleStore(self.environment, os.path.abspath(self.output))
+		stamp = hopper.utils.git.bundle.BundleStore.getStamp()
+		repositories = {}
+		for i in configuration.layers:
+			if isinstance(i.source, hopper.source.meta.GitSource):
+				clonename = hopper.utils.git.repo.getUriRepositoryName(i.source.remote)
+				if clonename in repositories:
+					continue
+
+				path = os.path.join(self.environment.getWorkingSourcesPath(), clonename)
+				gitrepo = hopper.utils.git.repo.Repository(self.environment, path)
+				since = previous.get(clonename, {}).get("commit")
+				repositories[clonename] = store.export(gitrepo, clonename, i.source.remote, i.source.ref, stamp, since)
+				gitrepo.close()
+
+		manifest = store.writeManifest(stamp, repositories)
+		log("Exported %d repositories, manifest written to '%s'" % (len(repositories), manifest))
+		return True
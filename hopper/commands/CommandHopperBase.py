@@ -36,6 +36,7 @@ class CommandHopperBase(hopper.utils.args.CommandBase):
 			None, "mirror",
 			default = None,
 			description = "The location of a git repository mirror. These repositories will be used to seed the clones.\n" +
+				"If the mirror is writable, hopper creates and updates the mirrors of the layer repositories itself.\n" +
 				"(This can be defined via the environment variable HOPPER_MIRROR.)")
 
 	locallayers = hopper.utils.args.ValueOption(
@@ -52,7 +53,7 @@ class CommandHopperBase(hopper.utils.args.CommandBase):
 		hopper.utils.args.CommandBase.execute(self)
 
 		if self.threadLimit:
-			threads = self.threadLimit
+			threads = int(self.threadLimit)
 		else:
 			threads = CommandHopperBase.getDefaultThreads()
 
@@ -0,0 +1,47 @@
+# Copyright (c) 2015 Xilinx Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+from hopper.utils.logger import *
+
+from CommandHopperBase import *
+import hopper.utils.args
+import hopper.utils.git.maintenance
+
+class CommandMaintain(CommandHopperBase):
+	CommandName = "maintain"
+
+	interval = hopper.utils.args.ValueOption(
+			None, "interval",
+			default = "86400",
+			description = "The minimum number of seconds between maintenance of a repository.")
+	force = hopper.utils.args.BooleanOption(
+			"f", "force",
+			default = False,
+			description = "Maintain all repositories regardless of when they were last maintained.")
+
+	def __init__(self):
+		CommandHopperBase.__init__(self)
+
+	def execute(self, handler = None):
+		CommandHopperBase.execute(self)
+
+		task = hopper.utils.git.maintenance.MaintenanceTask(self.environment, int(self.interval), self.force)
+		return task.execute(handler)
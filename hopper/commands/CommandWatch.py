@@ -0,0 +1,131 @@
+# Copyright (c) 2015 Xilinx Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import time
+import datetime
+
+from hopper.utils.logger import *
+
+from CommandBake import *
+import hopper.utils.args
+import hopper.utils.git.watcher
+
+class CommandWatch(CommandBake):
+	CommandName = ["watch"]
+
+	interval = hopper.utils.args.ValueOption(
+			None, "interval",
+			default = "30",
+			description = "The number of seconds between checks of the remotes for changes.")
+	debounce = hopper.utils.args.ValueOption(
+			None, "debounce",
+			default = "10",
+			description = "The number of seconds to wait for further changes after a change before building.\n" +
+				"(Changes which arrive while waiting or building are coalesced, only the newest state is built)")
+	watchmirror = hopper.utils.args.BooleanOption(
+			None, "watch-mirror",
+			default = False,
+			description = "Check for changes by fetching into the repository mirror instead of querying the remotes.\n" +
+				"(Requires a writable mirror, see --mirror)")
+	triggerfile = hopper.utils.args.ValueOption(
+			None, "trigger-file",
+			default = None,
+			description = "Check for changes immediately whenever the specified file is touched (e.g. by a post-receive hook).")
+	triggersocket = hopper.utils.args.ValueOption(
+			None, "trigger-socket",
+			default = None,
+			description = "Listen on the specified local socket, check for changes immediately whenever it is connected to.")
+	skipinitial = hopper.utils.args.BooleanOption(
+			None, "skip-initial-build",
+			default = False,
+			description = "Do not build the current state of the layers on startup, only build once changes occur.")
+
+	def __init__(self):
+		CommandBake.__init__(self)
+
+	def execute(self, handler = None):
+		CommandHopperBase.execute(self)
+
+		if not self.targets or len(self.targets) <= 0:
+			error("No bitbake targets provided, watch requires targets to build")
+			return False
+
+		configuration = self.getConfiguration()
+
+		watcher = hopper.utils.git.watcher.Watcher(self.environment)
+		watcher.usemirror = self.watchmirror
+		watcher.triggerfile = self.triggerfile
+		watcher.socketpath = self.triggersocket
+		watcher.addLayers(configuration.layers)
+
+		if not self.skipinitial:
+			watcher.trigger()
+		watcher.start(int(self.interval))
+
+		builds = {"succeeded" : 0, "failed" : 0}
+		try:
+			while watcher.alive():
+				change = self.__waitForChange__(watcher)
+				if change == None:
+					continue
+
+				note("Building changes detected at %s" % change.time)
+				if change.coalesced != 0:
+					log("Coalesced %d older changes" % change.coalesced)
+				for i in sorted(change.ranges.iteritems()):
+					log("  %s %s: %s..%s" % (i[0][0], i[0][1], i[1][0], i[1][1]))
+
+				try:
+					buildtask = self.getBuildTask(self.getConfiguration(change.pinned))
+					result = buildtask.execute()
+					if result is False or (result and result[0] != 0):
+						error("Build failed")
+						builds["failed"] += 1
+					else:
+						builds["succeeded"] += 1
+				except Exception as e:
+					error("Build failed: %s" % e)
+					builds["failed"] += 1
+
+				counters = watcher.getCounters()
+				note("Waiting for changes (seen %d, coalesced %d, built %d, succeeded %d, failed %d)" %
+						(counters["seen"], counters["coalesced"], counters["consumed"],
+						builds["succeeded"], builds["failed"]))
+		finally:
+			watcher.stop()
+		return True
+
+	# Waits for a change, and for the changes to settle (no further changes for the
+	# debounce period). Changes arriving while waiting are coalesced by the watcher.
+	def __waitForChange__(self, watcher):
+		debounce = int(self.debounce)
+		while watcher.alive():
+			change = watcher.peek()
+			if change == None:
+				watcher.wait(1)
+				continue
+
+			remaining = debounce - (datetime.datetime.utcnow() - change.time).total_seconds()
+			if remaining <= 0:
+				return watcher.getnext()
+			time.sleep(min(remaining, 1))
+		return None
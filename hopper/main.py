@@ -23,6 +23,9 @@ import os
 from hopper.utils.logger import *
 
 import hopper.commands.CommandBake
+import hopper.commands.CommandWatch
+import hopper.commands.CommandMaintain
+import hopper.commands.CommandBundle
 import hopper.utils.args
 import hopper.utils.console.TtyHelper
 import hopper.utils.git.repo
@@ -65,6 +68,9 @@ def main(args):
 			parser.setDefault(hopper.commands.CommandBake.CommandBake)
 			parser.addCommand(hopper.utils.args.CommandHelp)
 			parser.addCommand(hopper.commands.CommandBake.CommandBake)
+			parser.addCommand(hopper.commands.CommandWatch.CommandWatch)
+			parser.addCommand(hopper.commands.CommandMaintain.CommandMaintain)
+			parser.addCommand(hopper.commands.CommandBundle.CommandBundle)
 			command = parser.getCommand(args)
 			if command and command.execute(parser):
 				return 0
@@ -22,10 +22,19 @@
 import os
 import urllib2
 import urlparse
-import re
+import json
+import time
+import hashlib
 
 from hopper.utils.logger import *
+import hopper.utils.path
 
+# Client for the REST API of the OpenEmbedded Layer Index (layerItems, layerBranches
+# and layerDependencies), the responses are reduced to compact tables which are
+# cached on disk and revalidated (If-None-Match/If-Modified-Since) once stale.
+#
+# The base url may also be a 'file://' directory of recorded responses named
+# '<endpoint>.json', allowing the index to be used offline.
 class OELayerIndexCache:
 	cache = None
 	# TODO: Figure a way to populate these from layer index? (maybe assume subtree is also an alias)
@@ -42,93 +51,217 @@ class OELayerIndexCache:
 			},
 		}
 
+	baseurl = "http://layers.openembedded.org/layerindex/api/"
+
+	# seconds the on disk copy of the index is used without checking for changes
+	ttl = 24 * 60 * 60
+
+	# The shared index, the layers of the branches are searched in the order given
+	# (e.g. the requested series, then master)
 	@staticmethod
-	def getCache():
+	def getCache(branches = None):
+		branches = branches or ["master"]
 		if OELayerIndexCache.cache == None:
 			OELayerIndexCache.cache = OELayerIndexCache()
-			OELayerIndexCache.cache.update()
-		return OELayerIndexCache.cache
+		cache = OELayerIndexCache.cache
+		missing = [i for i in branches if i not in cache.branches]
+		if len(missing) != 0:
+			cache.update(missing)
+		cache.branches = branches + [i for i in cache.branches if i not in branches]
+		return cache
+
+	# The branches of the index used for a version (a branch/series name), falling
+	# back to master for versions which are not a branch of the index (e.g. commits)
+	@staticmethod
+	def getBranches(version = None):
+		if version and version != "master":
+			return [version, "master"]
+		return ["master"]
+
+	def __init__(self, baseurl = None):
+		self.baseurl = baseurl or OELayerIndexCache.baseurl
+		self.branches = []
+		self.layers = {} # branch -> name -> layer info
+
+	def getCachePath(self):
+		cachedir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+		key = hashlib.md5(self.baseurl).hexdigest()[0:16]
+		return os.path.join(cachedir, "hopper", "oe-layerindex-%s.json" % key)
+
+	@staticmethod
+	def __readcache__(path):
+		try:
+			with open(path, "r") as f:
+				cached = json.load(f)
+			if isinstance(cached, dict) and "endpoints" in cached:
+				return cached
+		except (IOError, OSError, ValueError):
+			pass
+		return None
+
+	@staticmethod
+	def __writecache__(path, cached):
+		try:
+			if not os.path.exists(os.path.dirname(path)):
+				os.makedirs(os.path.dirname(path))
+			hopper.utils.path.writeatomic(path, json.dumps(cached))
+		except (IOError, OSError) as e:
+			warning("Unable to store the OpenEmbedded Layer Index cache, %s" % e)
+
+	def getUrl(self, endpoint, filter = None):
+		base = self.baseurl.rstrip("/") + "/"
+		if urlparse.urlparse(base).scheme == "file":
+			# recorded responses, filtering is applied when reducing the data
+			return base + endpoint + ".json"
+		if filter:
+			return base + endpoint + "/?filter=" + filter
+		return base + endpoint + "/"
+
+	def update(self, branches = ["master"]):
+		path = self.getCachePath()
+		cached = OELayerIndexCache.__readcache__(path) or {"time" : 0, "endpoints" : {}}
+		fresh = (time.time() - cached["time"]) < OELayerIndexCache.ttl
+
+		requests = [("branches", self.getUrl("branches"), OELayerIndexCache.__reduceBranches__),
+				("layerItems", self.getUrl("layerItems"), OELayerIndexCache.__reduceItems__)]
+		for i in branches:
+			requests.append(("layerBranches", self.getUrl("layerBranches", "branch__name:%s" % i),
+					OELayerIndexCache.__reduceLayerBranches__))
+			requests.append(("layerDependencies", self.getUrl("layerDependencies", "layerbranch__branch__name:%s" % i),
+					OELayerIndexCache.__reduceDependencies__))
+
+		if not fresh or any(i[1] not in cached["endpoints"] for i in requests):
+			note("Updating OpenEmbedded Layer Index (retrieving from %s)" % self.baseurl)
+			for i in requests:
+				cached["endpoints"][i[1]] = self.__retrieve__(i[1], i[2], cached["endpoints"].get(i[1]))
+			cached["time"] = time.time()
+			OELayerIndexCache.__writecache__(path, cached)
+		else:
+			debug("Using cached OpenEmbedded Layer Index '%s'" % path)
+
+		endpoints = cached["endpoints"]
+		branchids = endpoints[requests[0][1]]["data"]
+		items = endpoints[requests[1][1]]["data"]
+		for index, branch in enumerate(branches):
+			layerbranches = endpoints[requests[2 + index * 2][1]]["data"]
+			dependencies = endpoints[requests[3 + index * 2][1]]["data"]
+			self.layers[branch] = OELayerIndexCache.__join__(branchids.get(branch),
+					items, layerbranches, dependencies)
+			if branch not in self.branches:
+				self.branches.append(branch)
+
+	# Retrieve and reduce an endpoint, the previous (cached) entry is reused if the
+	# endpoint is unchanged or cannot be retrieved
+	def __retrieve__(self, url, reduce, previous = None):
+		request = urllib2.Request(url)
+		if previous and previous.get("etag"):
+			request.add_header("If-None-Match", previous["etag"])
+		if previous and previous.get("lastmodified"):
+			request.add_header("If-Modified-Since", previous["lastmodified"])
+
+		try:
+			response = urllib2.urlopen(request)
+			# decoded directly from the response, the raw data is not kept
+			data = reduce(json.load(response))
+		except urllib2.HTTPError as e:
+			if e.code == 304 and previous:
+				debug("OpenEmbedded Layer Index '%s' is unchanged" % url)
+				return previous
+			if not previous:
+				raise
+			warning("Failed to update the OpenEmbedded Layer Index (%s), using the cached copy" % e)
+			return previous
+		except Exception as e:
+			if not previous:
+				raise
+			warning("Failed to update the OpenEmbedded Layer Index (%s), using the cached copy" % e)
+			return previous
+
+		info = response.info()
+		return {"data" : data,
+				"etag" : info.getheader("ETag") if info else None,
+				"lastmodified" : info.getheader("Last-Modified") if info else None}
 
-	def __init__(self):
-		self.layers = {}
+	# branch name -> branch id
+	@staticmethod
+	def __reduceBranches__(data):
+		return dict((i["name"], i["id"]) for i in data)
+
+	# layer id -> (name, remote, summary)
+	@staticmethod
+	def __reduceItems__(data):
+		items = {}
+		for i in data:
+			items[str(i["id"])] = (i["name"], i.get("vcs_url"), i.get("summary"))
+		return items
+
+	# (layerbranch id, branch id, layer id, subdirectory, actual branch)
+	@staticmethod
+	def __reduceLayerBranches__(data):
+		return [(i["id"], i["branch"], i["layer"], i.get("vcs_subdir") or "", i.get("actual_branch") or "") for i in data]
 
+	# (layerbranch id, dependency layer id, required)
 	@staticmethod
-	def __strip_subdirectory__(webrepo, webrepopath, branch = None):
-		cut = webrepopath.replace(webrepo, "")
-		# try stripping '/tree/' or '/tree/<branch>/'
-		if branch and cut.startswith("/tree/%s/" % branch):
-			cut = cut[len("/tree/%s/" % branch):]
-		if cut.startswith("/tree/"):
-			cut = cut[len("/tree/"):]
-		# split of '?h=master' types
-		queryparts = cut.split("?", 1)
-		if len(queryparts) > 1:
-			cut = queryparts[0]
-		return cut
-
-	def update(self, branch = "master"):
-		note("Updating OpenEmbedded Layer Index (retrieving from layers.openembedded.org)")
-		self.layers = {}
-		uri = "http://layers.openembedded.org/layerindex/branch/%s/layers/" % branch
-		response = urllib2.urlopen(uri)
-		data = response.read()
-		if data:
-			# get the layers table
-			m = re.search("<table class=\".*?layerstable.*?\">.*?<tbody>(.*?)</tbody>.*?</table>", data,
-					re.MULTILINE | re.DOTALL)
-			if m:
-				for i in re.finditer("<tr class=\"layertype_.\">(.*?)</tr>", m.group(1), re.MULTILINE | re.DOTALL):
-					sections = list(re.finditer("<td.*?>(.*?)</td>", i.group(1), re.MULTILINE | re.DOTALL))
-					shortname = None
-					if len(sections) >= 1:
-						# has shortname
-						shortname = re.search("<a.*?>(.*?)</a>", sections[0].group(1), re.DOTALL)
-						if shortname:
-							shortname = shortname.group(1)
-					longname = None
-					if len(sections) >= 2:
-						longname = sections[1].group(1)
-					group = None
-					if len(sections) >= 3:
-						group = sections[2].group(1)
-					remote = None
-					webrepo = None
-					treepath = None
-					if len(sections) >= 4:
-						remote = re.search("^\s*(.*?)$", sections[3].group(1), re.MULTILINE | re.DOTALL)
-						if remote:
-							remote = remote.group(1)
-						parts = list(re.finditer("<a.*?href=\"(.*?)\">", sections[3].group(1),
-								re.MULTILINE | re.DOTALL))
-						if len(parts) >= 1:
-							webrepo = parts[0].group(1)
-						if len(parts) >= 2:
-							treepath = OELayerIndexCache.__strip_subdirectory__(webrepo, parts[1].group(1), branch)
-
-					debug("OEIndex: adding '%s'/'%s' @ %s {%s}" % (shortname, longname, remote, treepath))
-					if shortname in self.layers:
-						# duplicate
-						raise Exception("Got duplicate entry in OE Layer Index")
-
-					info = {
-							"shortname" : shortname,
-							"description" : longname,
-							"remote" : remote,
-							"subpath" : treepath,
-							}
-					self.layers[shortname] = info
-
-	def find(self, name):
+	def __reduceDependencies__(data):
+		return [(i["layerbranch"], i["dependency"], i.get("required", True)) for i in data]
+
+	# json strings are unicode, the layer details are plain strings (e.g. the remote
+	# is hashed and formatted)
+	@staticmethod
+	def __encode__(value):
+		if isinstance(value, unicode):
+			return value.encode("utf-8")
+		return value
+
+	@staticmethod
+	def __join__(branchid, items, layerbranches, dependencies):
+		layers = {}
+		if branchid == None:
+			return layers
+
+		encode = OELayerIndexCache.__encode__
+		names = {}
+		for i in layerbranches:
+			if i[1] != branchid or str(i[2]) not in items:
+				continue
+			item = items[str(i[2])]
+			name = encode(item[0])
+			layers[name] = {
+					"shortname" : name,
+					"description" : encode(item[2]),
+					"remote" : encode(item[1]),
+					"subpath" : encode(i[3]),
+					"branch" : encode(i[4]) or None,
+					"dependencies" : [],
+					}
+			names[i[0]] = name
+
+		for i in dependencies:
+			if i[0] in names and str(i[1]) in items:
+				layers[names[i[0]]]["dependencies"].append((encode(items[str(i[1])][0]), i[2]))
+		return layers
+
+	def find(self, name, branch = None):
 		validnames = [name]
 		if name in OELayerIndexCache.aliases:
 			validnames.append(OELayerIndexCache.aliases[name])
 
 		# Check cache
-		for i in validnames:
-			if i in self.layers:
-				return self.layers[i]
+		for b in ([branch] if branch else self.branches):
+			layers = self.layers.get(b, {})
+			for i in validnames:
+				if i in layers:
+					return layers[i]
+
+		return OELayerIndexCache.findDefault(name)
+
+	# find using only the default values, does not require the index
+	@staticmethod
+	def findDefault(name):
+		validnames = [name]
+		if name in OELayerIndexCache.aliases:
+			validnames.append(OELayerIndexCache.aliases[name])
 
-		# Check default values
 		for i in validnames:
 			if i in OELayerIndexCache.default:
 				return OELayerIndexCache.default[i]
@@ -141,9 +274,8 @@ class OELayerIndexCache:
 			return OELayerIndexCache.aliases[name]
 		return None
 
-def findRepoDetails(name):
-	return OELayerIndexCache.getCache().findRepoDetails(name)
-
-def findLayerDetails(name, reponame = None):
-	return OELayerIndexCache.getCache().findLayerDetails(name, reponame)
+def findRepoDetails(name, version = None):
+	return OELayerIndexCache.getCache(OELayerIndexCache.getBranches(version)).find(name)
 
+def findLayerDetails(name, reponame = None, version = None):
+	return OELayerIndexCache.getCache(OELayerIndexCache.getBranches(version)).find(name)
@@ -22,19 +22,49 @@
 from hopper.utils.logger import *
 
 import os
+import re
 import urlparse
 import shutil
 
 import hopper.utils.tasks
 import meta
 import hopper.utils.git.repo
+import hopper.utils.git.mirror
+import hopper.utils.git.refcache
+import hopper.utils.git.bundle
+import hopper.utils.lock
+
+# Options which control how layer repositories are cloned and updated
+class LayerFetchOptions:
+	def __init__(self):
+		# shallow/partial clones
+		self.depth = None
+		self.filter = None
+		# fetch all tags when updating
+		self.tags = False
+		# use worktrees of the mirror instead of clones
+		self.worktree = False
+		# only checkout the subpaths of the layers used
+		self.sparse = False
+		# seconds a resolved remote ref is trusted for before querying the remote
+		self.refcachettl = None
+		# directory of bundles used before fetching from the remote
+		self.bundles = None
+		# enable the untracked cache/fsmonitor for faster dirty checks
+		self.untrackedcache = False
+		self.fsmonitor = None
 
 class LayerFetchGitTask(hopper.utils.tasks.TaskBase):
-	def __init__(self, environment, revision, forceupdate = False):
+	def __init__(self, environment, revision, forceupdate = False, options = None):
 		hopper.utils.tasks.TaskBase.__init__(self, environment)
 
 		self.revision = revision
 		self.forceupdate = forceupdate
+		self.options = options or LayerFetchOptions()
+
+		# subpaths of the layers used from this repository, None if the entire
+		# repository is used
+		self.subpaths = None
 
 	def __repr__(self):
 		if self.revision:
@@ -47,18 +77,64 @@ class LayerFetchGitTask(hopper.utils.tasks.TaskBase):
 			return False
 
 		clonename = hopper.utils.git.repo.getUriRepositoryName(self.revision.remote)
+
+		# held while the repository is being modified, maintenance skips locked repositories
+		with self.getLock(self.environment, clonename):
+			return self.__fetch__(clonename)
+
+	@staticmethod
+	def getLock(environment, clonename):
+		return hopper.utils.lock.FileLock(os.path.join(environment.getWorkingSourcesPath(), clonename + ".lock"))
+
+	def __fetch__(self, clonename):
 		path = os.path.join(self.environment.getWorkingSourcesPath(), clonename)
 		remoteuri = self.revision.remote
 		gitrepo = hopper.utils.git.repo.Repository(self.environment, path)
+		refcache = hopper.utils.git.refcache.ResolvedRefCache.getCache(self.environment, self.options.refcachettl)
+
+		if self.options.worktree:
+			return self.__executeWorktree__(gitrepo, clonename, remoteuri, refcache)
+
+		update = self.forceupdate and not self.__isCached__(gitrepo, clonename, refcache)
+
+		# Use the managed mirror (if available) to clone and fetch from
+		mirror = hopper.utils.git.mirror.MirrorStore(self.environment)
+		source = None
+		if mirror.enabled():
+			source = mirror.prepare(remoteuri, refresh = update or not gitrepo.valid())
 
 		# Need to clone repo
 		justcloned = False
-		if not gitrepo.valid():
+		sparse = self.getSparseDirectories()
+		bundles = None
+		if self.options.bundles:
+			bundles = hopper.utils.git.bundle.BundleStore(self.environment, self.options.bundles)
+			if not gitrepo.valid() and bundles.clone(gitrepo, clonename, remoteuri, checkout = not sparse):
+				justcloned = True
+
+		if not gitrepo.valid() and source:
+			self.environment.verbose("%s: Cloning from mirror..." % (clonename))
+			# the mirror is read under a shared lock, so maintenance does not run concurrently
+			with mirror.getLock(remoteuri, shared = True):
+				if not gitrepo.clone(source, overwrite = True, checkout = not sparse, shared = True):
+					raise Exception("Failed to clone '%s' from '%s'" % (clonename, source))
+			gitrepo.setRemoteUrl("origin", remoteuri)
+			justcloned = True
+		elif not gitrepo.valid():
 			self.environment.verbose("%s: Cloning..." % (clonename))
-			if not gitrepo.clone(remoteuri, overwrite = True):
+			branch = None
+			if self.options.depth and self.__isNamedRef__(gitrepo, remoteuri, self.revision.ref):
+				# shallow clones only contain the named branch/tag
+				branch = self.revision.ref
+			if not gitrepo.clone(remoteuri, overwrite = True,
+					depth = self.options.depth, filter = self.options.filter, branch = branch,
+					checkout = not sparse):
 				raise Exception("Failed to clone '%s' from '%s'" % (clonename, remoteuri))
 			justcloned = True
 
+		self.__sparse__(gitrepo, clonename, populate = justcloned)
+		self.__statusCache__(gitrepo, clonename)
+
 		# check for the remotes, dont assume its valid
 		remotes = gitrepo.getRemotes()
 		self.environment.debug("%s: remotes -> '%s'" % (clonename, remotes))
@@ -69,24 +145,52 @@ class LayerFetchGitTask(hopper.utils.tasks.TaskBase):
 				break
 		self.environment.debug("%s: remotename = '%s'" % (clonename, remotename))
 
-		if self.forceupdate and not justcloned:
-			if not gitrepo.remoteUpdate(remotename):
+		bundled = justcloned
+		if bundles and remotename:
+			bundled = bundles.apply(gitrepo, clonename, remotename) or bundled
+
+		if update and not justcloned:
+			if remotename and source:
+				with mirror.getLock(remoteuri, shared = True):
+					self.__update__(gitrepo, clonename, remotename, refcache, source)
+			elif remotename:
+				self.__update__(gitrepo, clonename, remotename, refcache, source)
+			elif not gitrepo.remoteUpdate(remotename):
 				raise Exception("Failed to fetch/update '%s'" % (clonename))
 
 		# determine the absolute ref/commit
 		ref = gitrepo.findRef(self.revision.ref, remotename)
+		if ref == None and remotename:
+			# not available locally (e.g. outside of a shallow clone), fetch it on demand
+			self.environment.log("%s: Fetching '%s'" % (clonename, self.revision.ref))
+			if source:
+				# the mirror may already have been refreshed, before the ref existed
+				mirror.update(remoteuri)
+				with mirror.getLock(remoteuri, shared = True):
+					fetched = gitrepo.fetchRef(remotename, self.revision.ref, None, source)
+			else:
+				fetched = gitrepo.fetchRef(remotename, self.revision.ref, self.options.depth)
+			if fetched:
+				ref = gitrepo.findRef(self.revision.ref, remotename)
+		if ref == None:
+			raise Exception("Unable to find ref/commit '%s' in '%s'" % (self.revision.ref, clonename))
 
 		# Ensure repo is checked out to the correct ref/commit
-		dirty = gitrepo.dirty()
 		head = gitrepo.getTreeRef()
 
 		validcheckout = False
 		if ref and head:
 			if (head[0] == None and ref[0] == None) or (head[0] == ref[0]):
 				if (head[1] == None and ref[1] == None or ref[1] == None) or (head[1] == ref[1]):
-					self.environment.log("%s: Already checked out at expected ref" % (clonename))
+					validcheckout = True
+			elif head[0] == None and ref[0] != None and ref[0].startswith("refs/tags/"):
+				# tags are checked out as a detached HEAD
+				if head[1] == ref[2] or head[1] == gitrepo.getPeeledCommit(ref[0]):
 					validcheckout = True
 
+		if validcheckout:
+			self.environment.log("%s: Already checked out at expected ref" % (clonename))
+
 		if not validcheckout:
 			self.environment.log("%s: Not checked out to a valid ref/commit" % (clonename))
 			if ref[0] != None:
@@ -99,20 +203,26 @@ class LayerFetchGitTask(hopper.utils.tasks.TaskBase):
 			else:
 				raise Exception("No ref/commit to checkout '%s'" % repr(ref))
 
-			if dirty:
+			if gitrepo.dirty():
 				raise Exception("Cannot checkout '%s' due to dirty state" % (clonename))
 
 			self.environment.log("%s: Checking out '%s'" % (clonename, objcheckout))
 			if not gitrepo.checkout(objcheckout):
 				raise Exception("Failed to checkout '%s' for '%s'" % (objcheckout, clonename))
 
-			# TODO: figure out how to update local ref
-			#if not gitrepo.pull():
+			# determine the ref after updating/adding a local branch
+			ref = gitrepo.findRef(self.revision.ref, remotename)
+			head = gitrepo.getTreeRef()
 
-		# determine the ref after updating/adding a local branch
-		ref = gitrepo.findRef(self.revision.ref, remotename)
-		dirty = gitrepo.dirty()
-		head = gitrepo.getTreeRef()
+		# bring the local branch up to date with the updated remote branch
+		if (update or bundled) and ref[0] != None and ref[0].startswith("refs/heads/"):
+			if head[0] == ref[0] and ref[2] != None and head[1] != ref[2]:
+				if gitrepo.dirty():
+					raise Exception("Cannot update '%s' due to dirty state" % (clonename))
+				self.environment.log("%s: Updating '%s' to %s" % (clonename, self.revision.ref, ref[2]))
+				if not gitrepo.fastForward(ref[2]):
+					raise Exception("Failed to update '%s' for '%s'" % (self.revision.ref, clonename))
+				head = gitrepo.getTreeRef()
 
 		# repo info
 		info = "%s:\n" % (clonename)
@@ -121,43 +231,196 @@ class LayerFetchGitTask(hopper.utils.tasks.TaskBase):
 		info += "  * path = %s\n" % path
 		info += "  * '%s' = %s\n" % (remotename, remoteuri)
 		self.environment.log(info)
+		gitrepo.close()
 
 		# return the path to the cloned repo
 		return path
 
-def generateLayerFetchTasks(environment, collection, forceupdate = False):
+	# The remote does not need to be queried if the ref was resolved recently (within
+	# the ref cache ttl) to the commit that is already checked out
+	def __isCached__(self, gitrepo, clonename, refcache):
+		if not gitrepo.valid():
+			return False
+		sha = refcache.get(self.revision.remote, self.revision.ref)
+		if sha == None:
+			return False
+		head = gitrepo.getTreeRef()
+		if head and head[1] == sha:
+			self.environment.log("%s: '%s' resolved to %s by the ref cache, skipping remote update" % (clonename, self.revision.ref, sha))
+			return True
+		return False
+
+	def getSparseDirectories(self):
+		if self.options.sparse and self.subpaths:
+			# the repository root conf and scripts directories are used by bitbake/hopper
+			return sorted(set(self.subpaths + ["conf", "scripts"]))
+		return None
+
+	# Ensures the sparse checkout of the repository matches the required subpaths,
+	# repositories cloned without a checkout are populated afterwards
+	def __sparse__(self, gitrepo, clonename, populate = False):
+		directories = self.getSparseDirectories() or []
+		if gitrepo.getSparseCheckout() != directories:
+			if directories:
+				self.environment.log("%s: Sparse checkout of %s" % (clonename, ", ".join(directories)))
+			else:
+				self.environment.log("%s: Disabling sparse checkout" % (clonename))
+			if not gitrepo.setSparseCheckout(directories):
+				raise Exception("Failed to setup sparse checkout for '%s'" % (clonename))
+
+		if populate and directories:
+			if not gitrepo.populate():
+				raise Exception("Failed to checkout '%s'" % (clonename))
+
+	def __statusCache__(self, gitrepo, clonename):
+		if self.options.untrackedcache or self.options.fsmonitor:
+			if not gitrepo.setStatusCache(self.options.untrackedcache, self.options.fsmonitor):
+				self.environment.warning("%s: Failed to enable the untracked cache/fsmonitor" % (clonename))
+
+	# Prepares the workspace as a detached worktree of the mirror, all workspaces of
+	# a remote share the objects of the single mirror repository
+	def __executeWorktree__(self, gitrepo, clonename, remoteuri, refcache):
+		mirror = hopper.utils.git.mirror.MirrorStore(self.environment)
+		if not mirror.enabled():
+			raise Exception("Worktree workspaces require a writable mirror (--mirror or HOPPER_MIRROR)")
+
+		path = gitrepo.getPath()
+		isworktree = mirror.isWorktree(remoteuri, path)
+		if gitrepo.valid() and not isworktree:
+			raise Exception("'%s' already exists and is not a worktree of the mirror" % path)
+
+		update = self.forceupdate and isworktree and not self.__isCached__(gitrepo, clonename, refcache)
+		source = mirror.prepare(remoteuri, refresh = update or not isworktree)
+		if not source:
+			raise Exception("Unable to use the mirror for '%s'" % (clonename))
+		shared = hopper.utils.git.repo.Repository(self.environment, source)
+
+		# resolve the commit in the mirror, refs of the mirror are the remotes refs
+		ref = shared.findRef(self.revision.ref)
+		if ref == None:
+			# the mirror may already have been refreshed, before the ref existed
+			mirror.update(remoteuri)
+			shared.invalidate()
+			ref = shared.findRef(self.revision.ref)
+		if ref == None:
+			raise Exception("Unable to find ref/commit '%s' in '%s'" % (self.revision.ref, clonename))
+		commit = shared.getPeeledCommit(ref[0]) if ref[0] else ref[1]
+		if (update or not isworktree) and ref[0]:
+			refcache.set(remoteuri, self.revision.ref, commit)
+
+		# the mirror lock guards the mirrors worktree metadata
+		with mirror.getLock(remoteuri):
+			if not isworktree:
+				if os.path.lexists(path):
+					if os.path.isdir(path) and not os.path.islink(path):
+						shutil.rmtree(path)
+					else:
+						os.remove(path)
+				# remove the metadata of worktrees which no longer exist
+				shared.pruneWorktrees()
+
+				self.environment.log("%s: Creating worktree at %s" % (clonename, commit))
+				if not shared.addWorktree(path, commit, checkout = not self.getSparseDirectories()):
+					raise Exception("Failed to create worktree for '%s'" % (clonename))
+				gitrepo.invalidate()
+				self.__sparse__(gitrepo, clonename, populate = True)
+			else:
+				self.__sparse__(gitrepo, clonename)
+				head = gitrepo.getTreeRef()
+				if head and head[1] == commit:
+					self.environment.log("%s: Already checked out at expected ref" % (clonename))
+				else:
+					if gitrepo.dirty():
+						raise Exception("Cannot checkout '%s' due to dirty state" % (clonename))
+					self.environment.log("%s: Checking out '%s' (%s)" % (clonename, self.revision.ref, commit))
+					if not gitrepo.checkout(commit):
+						raise Exception("Failed to checkout '%s' for '%s'" % (commit, clonename))
+
+		self.__statusCache__(gitrepo, clonename)
+
+		info = "%s:\n" % (clonename)
+		info += "  * head     = %s\n" % (repr(gitrepo.getTreeRef()))
+		info += "  * expected = %s -> sha = %s\n" % (repr(ref[0] or ref[1]), commit)
+		info += "  * path = %s (worktree of %s)\n" % (path, source)
+		self.environment.log(info)
+		gitrepo.close()
+		shared.close()
+
+		return path
+
+	# Whether the ref is a branch/tag name rather than a commit, names which look like
+	# an abbreviated commit (e.g. 'cafe') are resolved on the remote
+	def __isNamedRef__(self, gitrepo, remoteuri, ref):
+		if re.match("^[0-9a-f]{40}$", ref):
+			return False
+		if not re.match("^[0-9a-f]{4,39}$", ref):
+			return True
+		remoterefs = gitrepo.lsRemote(remoteuri, ["refs/heads/%s" % ref, "refs/tags/%s" % ref])
+		return bool(remoterefs)
+
+	# Fetch only the requested ref from the remote, and only if it has changed
+	def __update__(self, gitrepo, clonename, remotename, refcache, source = None):
+		ref = self.revision.ref
+		if re.match("^[0-9a-f]{40}$", ref):
+			# commits do not change, missing commits are fetched on demand
+			return
+
+		branch = "refs/heads/%s" % ref
+		tag = "refs/tags/%s" % ref
+		remoterefs = gitrepo.lsRemote(source or remotename, [branch, tag, tag + "^{}"])
+		if remoterefs == None:
+			raise Exception("Failed to query remote for '%s'" % (clonename))
+
+		if branch in remoterefs:
+			sha = remoterefs[branch]
+			localref = "refs/remotes/%s/%s" % (remotename, ref)
+			current = gitrepo.getRefCommit(localref)
+			refspec = "+%s:%s" % (branch, localref)
+		elif tag in remoterefs:
+			sha = remoterefs.get(tag + "^{}", remoterefs[tag])
+			current = gitrepo.getPeeledCommit(tag) if gitrepo.getRefCommit(tag) else None
+			refspec = "+%s:%s" % (tag, tag)
+		else:
+			self.environment.warning("%s: '%s' does not exist on the remote" % (clonename, ref))
+			return
+		refcache.set(self.revision.remote, ref, sha)
+
+		head = gitrepo.getTreeRef()
+		if (head and head[1] == sha) or current == sha:
+			self.environment.log("%s: '%s' is up to date with the remote" % (clonename, ref))
+			return
+
+		self.environment.log("%s: Fetching '%s' (%s)" % (clonename, ref, sha))
+		if not gitrepo.fetch(source or remotename, [refspec],
+				None if source else self.options.depth, tags = self.options.tags):
+			raise Exception("Failed to fetch/update '%s'" % (clonename))
+		if branch in remoterefs:
+			gitrepo.addRemoteBranch(remotename, ref)
+
+def generateLayerFetchTasks(environment, collection, forceupdate = False, options = None):
 	tasks = []
 
 	if collection:
-		# find all remotes and revisions
-		# TODO: fix so that the magic string is the name of the repo/layer
-		srcs = {}
-		for i in collection:
-			if isinstance(i.source, meta.GitSource):
-				clonename = hopper.utils.git.repo.getUriRepositoryName(i.source.remote)
-				if clonename not in srcs:
-					srcs[clonename] = (i.source, [i.getName()])
-				else:
-					# already in the list, check if the revision is matching
-					current = srcs[clonename]
-					if current[0].ref != i.source.ref:
+		# the collection is indexed by repository (clone name for git sources)
+		for i in collection.getRepositories():
+			source = i[1]
+			if isinstance(source, meta.GitSource):
+				subpaths = []
+				for l in i[2]:
+					if l.source.ref != source.ref:
 						# TODO: handle this case
-						environment.error("Mis-matched sources between layers (%s and %s)" % (current[1], i.getName()))
-						raise Exception("Mis-matched sources between layers (%s and %s)" % (current[1], i.getName()))
-					else:
-						srcs[clonename][1].append(i.getName())
-			elif isinstance(i.source, meta.LocalSource):
-				if i.source.name not in srcs:
-					srcs[i.source.name] = (i.source, [i.source.name])
-				else:
-					# already in list, check mis-match
-					raise Exception("TODO")
+						environment.error("Mis-matched sources between layers (%s and %s)" % (i[2][0].getName(), l.getName()))
+						raise Exception("Mis-matched sources between layers (%s and %s)" % (i[2][0].getName(), l.getName()))
+					if subpaths != None:
+						if l.getPath() and not l.isBitBake():
+							subpaths.append(l.getPath())
+						else:
+							subpaths = None
 
-		for i in srcs.iteritems():
-			if isinstance(i[1][0], meta.GitSource):
-				task = LayerFetchGitTask(environment, i[1][0], forceupdate)
+				task = LayerFetchGitTask(environment, source, forceupdate, options)
+				task.subpaths = subpaths
 				tasks.append(task)
-			elif isinstance(i[1][0], meta.LocalSource):
+			elif isinstance(source, meta.LocalSource):
 				pass
 
 	return tasks
@@ -0,0 +1,74 @@
+# Copyright (c) 2015 Xilinx Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import json
+
+from hopper.utils.logger import *
+import hopper.utils.git.repo
+import hopper.utils.path
+import meta
+
+# Records the layers of a collection with the commits their refs resolved to, a
+# locked collection is created directly from the lockfile without the layer
+# index or any ref resolution
+class LayerLock:
+	version = 1
+
+	@staticmethod
+	def write(path, environment, layers):
+		entries = []
+		for i in layers:
+			entry = {"name" : i.getName(), "path" : i.getPath() or None}
+			if isinstance(i.source, meta.GitSource):
+				gitrepo = hopper.utils.git.repo.Repository(environment, i.source.getPath(environment))
+				head = gitrepo.getTreeRef()
+				gitrepo.close()
+				if not head:
+					raise Exception("Unable to determine the commit of layer '%s'" % i.getFullName())
+				entry["remote"] = i.source.remote
+				entry["ref"] = i.source.ref
+				entry["commit"] = head[1]
+			elif isinstance(i.source, meta.LocalSource):
+				entry["local"] = i.source.name
+				entry["localpath"] = i.source.path
+			entries.append(entry)
+
+		hopper.utils.path.writeatomic(path,
+				json.dumps({"version" : LayerLock.version, "layers" : entries}, indent = 1, sort_keys = True))
+
+	@staticmethod
+	def read(path, defaultversion = None):
+		with open(path, "r") as f:
+			data = json.load(f)
+		if data.get("version") != LayerLock.version:
+			raise Exception("Unsupported layer lockfile version in '%s'" % path)
+
+		collection = meta.LayerCollection(defaultversion)
+		for i in data.get("layers", []):
+			if "commit" in i:
+				source = meta.GitSource(i["remote"], i["commit"])
+			elif "local" in i:
+				source = meta.LocalSource(i["local"], i.get("localpath"))
+			else:
+				raise Exception("Invalid layer '%s' in lockfile '%s'" % (i.get("name"), path))
+			collection.addLayer(meta.Layer(i["name"], i.get("path"), source))
+		return collection
@@ -24,7 +24,9 @@ import urlparse
 
 from hopper.utils.logger import *
 
-class LocalSource:
+class LocalSource(object):
+	__slots__ = ["name", "path"]
+
 	def __init__(self, name, path = None):
 		self.name = name
 		self.path = path
@@ -47,7 +49,12 @@ class LocalSource:
 	def __repr__(self):
 		return "LocalSource (%s@%s)" % (self.name, self.path)
 
-class GitSource:
+	def getKey(self):
+		return self.name
+
+class GitSource(object):
+	__slots__ = ["remote", "ref"]
+
 	def __init__(self, remote, ref):
 		self.remote = remote
 		self.ref = ref
@@ -66,6 +73,10 @@ class GitSource:
 	def __repr__(self):
 		return "GitSource (%s@%s)" % (self.ref, self.remote)
 
+	# the key of the repository, sources with the same key share a clone
+	def getKey(self):
+		return GitSource.getUriCloneName(self.remote) if self.remote else None
+
 	@staticmethod
 	def getUriCloneName(uri):
 		url = urlparse.urlparse(uri)
@@ -74,7 +85,9 @@ class GitSource:
 			clonename = clonename[0:len(clonename) - len(".git")]
 		return clonename
 
-class Layer:
+class Layer(object):
+	__slots__ = ["name", "path", "source"]
+
 	def __init__(self, name, path = None, source = None):
 		self.name = name
 		self.path = path
@@ -113,10 +126,17 @@ class Layer:
 		return "Meta '%s' {%s} (source = %s)" % (self.name, self.path, self.source)
 
 # Handles parsing and filling in data about layers and repos
+#
+# The layers are indexed by name and by repository (the key of their source), the
+# indexes are shared between clones of a collection until either is modified.
 class LayerCollection:
 	def __init__(self, defaultversion = None):
 		self.indexes = []
+		self.providers = []
 		self.layers = []
+		self.names = {} # name -> position in layers
+		self.repos = {} # source key -> [names]
+		self.shared = False
 
 		self.defaultversion = GitSource(None, defaultversion)
 
@@ -126,18 +146,85 @@ class LayerCollection:
 	def __len__(self):
 		return len(self.layers)
 
+	def __contains__(self, layer):
+		position = self.names.get(layer.getName())
+		return position != None and self.layers[position] is layer
+
+	# Copy of the collection, the layers and indexes are only copied once either
+	# collection is modified
+	def clone(self):
+		collection = LayerCollection()
+		collection.indexes = list(self.indexes)
+		collection.providers = list(self.providers)
+		collection.defaultversion = self.defaultversion
+		collection.layers = self.layers
+		collection.names = self.names
+		collection.repos = self.repos
+		collection.shared = True
+		self.shared = True
+		return collection
+
+	def __own__(self):
+		if self.shared:
+			self.layers = list(self.layers)
+			self.names = dict(self.names)
+			self.repos = dict((i[0], list(i[1])) for i in self.repos.iteritems())
+			self.shared = False
+
+	def getLayer(self, name):
+		position = self.names.get(name)
+		if position != None:
+			return self.layers[position]
+		return None
+
+	# layers grouped by repository, as (key, source of the first layer, [layers])
+	def getRepositories(self):
+		repos = []
+		for i in self.repos.iteritems():
+			layers = [self.layers[self.names[n]] for n in i[1]]
+			repos.append((i[0], layers[0].source, layers))
+		return repos
+
+	@staticmethod
+	def __key__(layer):
+		if layer.source:
+			return layer.source.getKey()
+		return None
+
+	def __addindex__(self, layer):
+		key = LayerCollection.__key__(layer)
+		if key != None:
+			self.repos.setdefault(key, []).append(layer.getName())
+
+	def __removeindex__(self, layer):
+		key = LayerCollection.__key__(layer)
+		if key in self.repos:
+			self.repos[key].remove(layer.getName())
+			if len(self.repos[key]) == 0:
+				del self.repos[key]
+
+	# Replaces the source of a layer (layers are not modified, they may be shared
+	# with clones), returns the new layer
+	def setSource(self, layer, source):
+		position = self.names[layer.getName()]
+		self.__own__()
+		newlayer = Layer(layer.name, layer.path, source)
+		self.__removeindex__(self.layers[position])
+		self.layers[position] = newlayer
+		self.__addindex__(newlayer)
+		return newlayer
+
 	def addIndex(self, index):
 		self.indexes.append(index)
 
+	# Registers an index which is only created (e.g. downloaded) once a layer cannot
+	# be found without it, local is used to find layers without creating the index
+	def addIndexProvider(self, provider, local = None):
+		self.providers.append((provider, local))
+
 	# validates that the layers and bitbake is available
 	def validate(self, warnonly = False):
-		hasBitbake = False
-		for i in self.layers:
-			if i.isBitBake():
-				hasBitbake = True
-				break
-
-		if not hasBitbake:
+		if not self.getLayer("bitbake"):
 			if warnonly:
 				warning("BitBake is missing from the described layers.")
 			else:
@@ -146,12 +233,12 @@ class LayerCollection:
 						LayerCollection.getLayerNameTriple("bitbake", False),
 						GitSource(None, "master"))
 				if bblayer:
-					self.layers.append(bblayer)
+					self.addLayer(bblayer)
 				else:
 					error("Could not find BitBake")
 					return False
 
-		# TODO: check dependencies
+		# the dependencies are checked once the layers are fetched (see LayerDependencyResolver)
 
 		return True
 
@@ -165,7 +252,7 @@ class LayerCollection:
 
 			clayer = self.__findlayer__(names, revision)
 			if clayer:
-				self.layers.append(clayer)
+				self.addLayer(clayer)
 
 	def add(self, name, version = None):
 		names = LayerCollection.getLayerNameTriple(name, False)
@@ -173,18 +260,26 @@ class LayerCollection:
 
 		layer = self.__findlayer__(names, revision)
 		if layer:
-			if layer not in self.layers:
-				self.layers.append(layer)
-			return layer
+			return self.addLayer(layer)
 		return None
 
+	# add an already resolved layer, returns the layer of the collection with the same name
+	def addLayer(self, layer):
+		existing = self.getLayer(layer.getName())
+		if existing:
+			return existing
+		self.__own__()
+		self.names[layer.getName()] = len(self.layers)
+		self.layers.append(layer)
+		self.__addindex__(layer)
+		return layer
+
 	def __findlayer__(self, names, revision = None):
 		layer = None
 		# check the collection first
-		if self.layers:
-			for i in self.layers:
-				if i.getName() == names[1]:
-					return i
+		existing = self.getLayer(names[1])
+		if existing:
+			return existing
 
 		subpath = names[2] or ""
 		if revision != None and revision.canFetch():
@@ -220,19 +315,40 @@ class LayerCollection:
 			found = i.find(name)
 			if found:
 				return found
+
+		# search without creating the indexes
+		for i in self.providers:
+			if i[1]:
+				found = i[1](name)
+				if found:
+					return found
+
+		while len(self.providers) != 0:
+			index = self.providers[0][0]()
+			self.providers.pop(0)
+			self.indexes.append(index)
+			found = index.find(name)
+			if found:
+				return found
 		return None
 
-	def hash(layers):
+	# hash of the layers and their sources, the commits (full name -> commit) the
+	# refs were resolved to are included if provided
+	def hash(self, commits = None):
 		import hashlib
 		hashstrings = []
-		for i in layers:
+		for i in self.layers:
 			fullname = i.getFullName()
 			revstring = ""
 			if isinstance(i.source, GitSource):
 				revstring = "%s@%s" % (i.source.ref, i.source.remote)
+			elif isinstance(i.source, LocalSource):
+				revstring = "local@%s" % i.source.path
 			m = hashlib.md5()
 			m.update(fullname)
 			m.update(revstring)
+			if commits and fullname in commits:
+				m.update(commits[fullname])
 			hashstrings.append((fullname, m.hexdigest()))
 
 		# sort the strings according to fullname order
@@ -21,39 +21,55 @@
 import sys
 import os
 import re
+import json
 
 from hopper.utils.logger import *
+import hopper.utils.tasks
+import hopper.utils.path
+import hopper.utils.git.refs
 
 class BitBakeScanner:
+	cachename = "layer-conf-versions.json"
+	versionpattern = re.compile("LAYER_CONF_VERSION.*=.*\"(\\d+)\"")
+
+	# Scans a single layer for its sanity.conf and distro conf versions
+	class LayerScanTask(hopper.utils.tasks.TaskBase):
+		def __init__(self, environment, layer, path):
+			hopper.utils.tasks.TaskBase.__init__(self, environment)
+			self.layer = layer
+			self.path = path
+
+		def __repr__(self):
+			return "Scan '%s'" % self.layer.getName()
+
+		def execute(self, handler = None):
+			return BitBakeScanner.scanLayer(self.layer, self.path)
+
 	@staticmethod
 	def scanLayerConfVersion(environment, layers):
 		layerDefaultVersion = 6
 		layerVersions = {}
-		# Scan all layers for bblayers sample
+
+		scans = BitBakeScanner.__scanLayers__(environment, layers)
+
+		# Special parsing for 'meta' layer
 		for i in layers:
-			# Special parsing for 'meta' layer
-			if i.getName() == "meta":
-				expectedSanityPath = os.path.join(i.getSourcePath(environment), "conf", "sanity.conf")
-				if os.path.isfile(expectedSanityPath):
-					layerDefaultVersion = BitBakeScanner.scanFileForLayerConfVersion(expectedSanityPath)
-					debug("BitBakeScanner: Default 'meta' Layer vesion = %s" % layerDefaultVersion)
+			if i.getName() == "meta" and scans.get(i.getName()) and scans[i.getName()]["sanity"]:
+				layerDefaultVersion = scans[i.getName()]["sanity"][0]
+				debug("BitBakeScanner: Default 'meta' Layer vesion = %s" % layerDefaultVersion)
 
 		for i in layers:
-			distroPath = os.path.join(i.getSourcePath(environment), "conf", "distro")
-			if os.path.isdir(distroPath):
+			scan = scans.get(i.getName())
+			if scan and scan["distros"] != None:
 				layerdefault = layerDefaultVersion
 				missing = []
-				for c in os.listdir(distroPath):
-					if c.endswith(".conf"):
-						name = os.path.splitext(c)[0]
-						path = os.path.join(distroPath, c)
-						debug("BitBakeScanner: Distro found in Layer '%s' at %s" % (i.getName(), path))
-						lconfversion = BitBakeScanner.scanFileForLayerConfVersion(path)
-						layerVersions[name] = lconfversion
-						if lconfversion == None:
-							missing.append(name)
-						if layerdefault == None and lconfversion != None:
-							layerdefault = lconfversion
+				for name, lconfversion in scan["distros"]:
+					debug("BitBakeScanner: Distro '%s' found in Layer '%s'" % (name, i.getName()))
+					layerVersions[name] = lconfversion
+					if lconfversion == None:
+						missing.append(name)
+					if layerdefault == None and lconfversion != None:
+						layerdefault = lconfversion
 
 				for m in missing:
 					layerVersions[m] = layerdefault
@@ -64,12 +80,116 @@ class BitBakeScanner:
 
 		return (layerDefaultVersion, layerVersions)
 
+	# Scan the layers (concurrently), layers which are unchanged since they were last
+	# scanned use the cached result. Returns layer name -> scan.
+	@staticmethod
+	def __scanLayers__(environment, layers):
+		cachepath = os.path.join(environment.getWorkingBuildPath(), BitBakeScanner.cachename)
+		cache = BitBakeScanner.__readcache__(cachepath)
+
+		scans = {}
+		tasks = []
+		keys = {}
+		for i in layers:
+			path = i.getSourcePath(environment)
+			if not path:
+				continue
+			keys[path] = BitBakeScanner.getLayerKey(i.getRootSourcePath(environment), path)
+			entry = cache.get(path)
+			if keys[path] and entry and entry.get("key") == keys[path]:
+				scans[i.getName()] = entry["scan"]
+			else:
+				tasks.append(BitBakeScanner.LayerScanTask(environment, i, path))
+
+		if len(tasks) != 0:
+			debug("BitBakeScanner: Scanning %d of %d layers" % (len(tasks), len(keys)))
+			executor = hopper.utils.tasks.TaskExecutor(environment)
+			for i in tasks:
+				executor.add(i)
+			results = executor.execute()
+
+			for task, scan in zip(tasks, results):
+				scans[task.layer.getName()] = scan
+				if keys[task.path]:
+					cache[task.path] = {"key" : keys[task.path], "scan" : scan}
+			BitBakeScanner.__writecache__(cachepath, cache)
+
+		return scans
+
+	@staticmethod
+	def __readcache__(path):
+		try:
+			with open(path, "r") as f:
+				cache = json.load(f)
+			if isinstance(cache, dict):
+				return cache
+		except (IOError, OSError, ValueError):
+			pass
+		return {}
+
+	@staticmethod
+	def __writecache__(path, cache):
+		try:
+			if not os.path.exists(os.path.dirname(path)):
+				os.makedirs(os.path.dirname(path))
+			hopper.utils.path.writeatomic(path, json.dumps(cache))
+		except (IOError, OSError) as e:
+			warning("BitBakeScanner: Unable to store the scan cache, %s" % e)
+
+	# The key of the layer content which is scanned, the modification times of the
+	# scanned files (edits in the working tree) combined with the commit of git
+	# repositories
+	@staticmethod
+	def getLayerKey(rootpath, path):
+		mtimes = []
+		confpath = os.path.join(path, "conf")
+		for i in [os.path.join(confpath, "sanity.conf"), os.path.join(confpath, "distro")]:
+			if os.path.exists(i):
+				mtimes.append("%s:%r" % (i, os.path.getmtime(i)))
+		for name, filepath in BitBakeScanner.listConfs(os.path.join(confpath, "distro")):
+			mtimes.append("%s:%r" % (name, os.path.getmtime(filepath)))
+		key = "mtime:%s" % ";".join(mtimes)
+
+		state = hopper.utils.git.refs.GitDirectory(rootpath).readRefState() if rootpath else None
+		if state and state.head:
+			key = "commit:%s;%s" % (state.head[1], key)
+		return key
+
+	# Lists the '.conf' files of a directory as (name, path)
+	@staticmethod
+	def listConfs(path):
+		confs = []
+		if not os.path.isdir(path):
+			return confs
+		for i in os.listdir(path):
+			filepath = os.path.join(path, i)
+			if i.endswith(".conf") and os.path.isfile(filepath):
+				confs.append((i, filepath))
+		return sorted(confs)
+
+	# Returns the scan of a layer {"sanity" : [version] or None, "distros" : [(distro, version)] or None}
+	@staticmethod
+	def scanLayer(layer, path):
+		scan = {"sanity" : None, "distros" : None}
+		sanitypath = os.path.join(path, "conf", "sanity.conf")
+		if os.path.isfile(sanitypath):
+			scan["sanity"] = [BitBakeScanner.scanFileForLayerConfVersion(sanitypath)]
+
+		distropath = os.path.join(path, "conf", "distro")
+		if os.path.isdir(distropath):
+			scan["distros"] = []
+			for name, filepath in BitBakeScanner.listConfs(distropath):
+				scan["distros"].append((os.path.splitext(name)[0], BitBakeScanner.scanFileForLayerConfVersion(filepath)))
+		return scan
+
 	@staticmethod
 	def scanFileForLayerConfVersion(filepath):
 		if os.path.isfile(filepath):
 			with open(filepath, "r") as sampleFile:
-				match = re.search("LAYER_CONF_VERSION.*=.*\"(\\d+)\"", sampleFile.read())
-				if match:
-					version = int(match.group(1))
-					return version
+				# the version is on a single line, stop at the first match
+				for line in sampleFile:
+					match = BitBakeScanner.versionpattern.search(line)
+					if match:
+						version = int(match.group(1))
+						return version
 		return None
@@ -102,6 +102,8 @@ class BitBakeTask(hopper.utils.process.Process):
 		self.config = config
 		self.bbenvironment = {}
 		self.overwrite = True
+		# the configuration is only generated if it may have changed
+		self.generate = True
 		self.sublogger = None
 
 	@staticmethod
@@ -139,10 +141,11 @@ class BitBakeTask(hopper.utils.process.Process):
 		if not self.config:
 			raise Exception("BitBake Configuration is missing from the task.")
 
-		self.environment.log("Prepare BitBake Configuration")
-		configgen = hopper.utils.bitbake.config.ConfigurationGenerator(self.environment, self.config)
-		if not configgen.generate(overwrite = self.overwrite):
-			raise Exception("Failed to generate configuration")
+		if self.generate:
+			self.environment.log("Prepare BitBake Configuration")
+			configgen = hopper.utils.bitbake.config.ConfigurationGenerator(self.environment, self.config)
+			if not configgen.generate(overwrite = self.overwrite):
+				raise Exception("Failed to generate configuration")
 
 		if self.sublogger:
 			self.redirect = True
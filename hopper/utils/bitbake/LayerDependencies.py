@@ -0,0 +1,290 @@
+# Copyright (c) 2015 Xilinx Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import re
+import json
+
+from hopper.utils.logger import *
+import hopper.utils.git.repo
+import hopper.utils.path
+import hopper.source.meta
+
+# Reads the collections, dependencies and series compatibility of the layers from
+# their conf/layer.conf, so that missing/incompatible layers are found before
+# bitbake is started. The variables of the layer.conf files are parsed (not fully
+# evaluated like bitbake does), references to variables which are unknown leave the
+# value unknown and it is not checked. The parsed variables are cached keyed by the
+# layers commit and the layer.conf stat.
+class LayerDependencyResolver:
+	cachename = "layer-dependencies.json"
+	cacheversion = 2
+
+	varpattern = re.compile("^\\s*(?:export\\s+)?([A-Za-z0-9_\\-\\.\\${}/]+)((?::[A-Za-z0-9_\\-]+)*)\\s*(\\?\\?=|\\?=|:=|\\+=|=\\+|\\.=|=\\.|=)\\s*(\"(.*)\"|'(.*)')\\s*$")
+	refpattern = re.compile("\\$\\{([A-Za-z0-9_\\-:]+)\\}")
+	constraintpattern = re.compile("^\\((>=|<=|>|<|=)\\s*(\\d+)\\)$")
+
+	def __init__(self, environment, layers):
+		self.environment = environment
+		self.layers = layers
+		self.cache = None
+
+	def getCachePath(self):
+		return os.path.join(self.environment.getWorkingBuildPath(), LayerDependencyResolver.cachename)
+
+	def __loadcache__(self):
+		if self.cache == None:
+			self.cache = {}
+			try:
+				with open(self.getCachePath(), "r") as f:
+					cache = json.load(f)
+				if isinstance(cache, dict) and cache.get("version") == LayerDependencyResolver.cacheversion:
+					self.cache = cache
+			except (IOError, OSError, ValueError):
+				pass
+			self.cache["version"] = LayerDependencyResolver.cacheversion
+			self.cache.setdefault("layers", {})
+		return self.cache["layers"]
+
+	def __savecache__(self):
+		path = self.getCachePath()
+		if not os.path.exists(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		hopper.utils.path.writeatomic(path, json.dumps(self.cache))
+
+	# the commit of git layers, and the stat of the layer.conf (modified in the
+	# working tree, or a local layer)
+	def __getkey__(self, layer, confpath):
+		stat = os.stat(confpath)
+		key = "%s:%r:%d" % (confpath, stat.st_mtime, stat.st_size)
+		if isinstance(layer.source, hopper.source.meta.GitSource):
+			gitrepo = hopper.utils.git.repo.Repository(self.environment, layer.getRootSourcePath(self.environment))
+			head = gitrepo.getTreeRef()
+			gitrepo.close()
+			if head:
+				key = "%s:%s" % (head[1], key)
+		return key
+
+	# Parses the variable assignments of a layer.conf, values keep their references
+	# (e.g. '${LAYERSERIES_COMPAT_core}') which are expanded when checking
+	@staticmethod
+	def parseLayerConf(path):
+		values = {}
+		with open(path, "r") as f:
+			content = f.read().replace("\\\n", " ")
+
+		for line in content.splitlines():
+			m = LayerDependencyResolver.varpattern.match(line)
+			if not m:
+				continue
+			key, overrides, operator = m.group(1), m.group(2), m.group(3)
+			value = m.group(5) if m.group(5) != None else m.group(6)
+
+			# old style (_append) and new style (:append) override operations
+			operation = None
+			for o in ["append", "prepend", "remove"]:
+				if overrides == ":" + o:
+					operation = o
+				elif not overrides and key.endswith("_" + o):
+					operation = o
+					key = key[0:len(key) - len(o) - 1]
+			if overrides and not operation:
+				# conditional overrides are not evaluated
+				continue
+
+			current = values.get(key, "")
+			if operation == "append":
+				values[key] = current + value
+			elif operation == "prepend":
+				values[key] = value + current
+			elif operation == "remove":
+				values[key] = " ".join(i for i in current.split() if i not in value.split())
+			elif operator == "+=":
+				values[key] = (current + " " + value).strip()
+			elif operator == "=+":
+				values[key] = (value + " " + current).strip()
+			elif operator == ".=":
+				values[key] = current + value
+			elif operator == "=.":
+				values[key] = value + current
+			elif operator in ["?=", "??="]:
+				values.setdefault(key, value)
+			else:
+				values[key] = value
+		return values
+
+	# Expands the references of a value, None if a reference is unknown
+	@staticmethod
+	def expand(value, variables):
+		for i in range(0, 10):
+			if "${" not in value:
+				return value
+			unknown = []
+			def replace(m):
+				if m.group(1) in variables:
+					return variables[m.group(1)]
+				unknown.append(m.group(1))
+				return m.group(0)
+			value = LayerDependencyResolver.refpattern.sub(replace, value)
+			if len(unknown) != 0:
+				return None
+		return None
+
+	# "core (>= 12) openembedded-layer" -> [("core", (">=", 12)), ("openembedded-layer", None)]
+	@staticmethod
+	def parseDepends(value):
+		depends = []
+		for i in re.findall("[^\\s(]+(?:\\s*\\([^)]*\\))?", value):
+			parts = i.split("(", 1)
+			constraint = None
+			if len(parts) > 1:
+				m = LayerDependencyResolver.constraintpattern.match("(" + parts[1].replace(" ", ""))
+				if m:
+					constraint = (m.group(1), int(m.group(2)))
+			depends.append((parts[0].strip(), constraint))
+		return depends
+
+	def scan(self):
+		cache = self.__loadcache__()
+		changed = False
+		scanned = []
+		for i in self.layers:
+			if i.isBitBake() or not i.source:
+				continue
+			sourcepath = i.getSourcePath(self.environment)
+			confpath = os.path.join(sourcepath, "conf", "layer.conf") if sourcepath else None
+			if not confpath or not os.path.isfile(confpath):
+				self.environment.debug("No layer.conf for layer '%s'" % i.getName())
+				continue
+
+			key = self.__getkey__(i, confpath)
+			entry = cache.get(confpath)
+			if not entry or entry.get("key") != key:
+				entry = {"key" : key, "values" : LayerDependencyResolver.parseLayerConf(confpath)}
+				cache[confpath] = entry
+				changed = True
+			scanned.append((i, entry["values"]))
+
+		if changed:
+			self.__savecache__()
+		return scanned
+
+	# Returns the problems found, as (layer, message) and the missing collections
+	def check(self):
+		scanned = self.scan()
+
+		# as in bitbake the variables of all layer.conf files are in one datastore
+		variables = {}
+		for i in scanned:
+			for v in i[1].iteritems():
+				if v[0] == "BBFILE_COLLECTIONS":
+					continue
+				variables[v[0]] = v[1]
+
+		collections = {}
+		layercollections = []
+		for i in scanned:
+			names = (LayerDependencyResolver.expand(i[1].get("BBFILE_COLLECTIONS", ""), variables) or "").split()
+			layercollections.append((i[0], names))
+			for c in names:
+				collections[c] = i[0]
+
+		corenames = (LayerDependencyResolver.expand(variables.get("LAYERSERIES_CORENAMES", ""), variables) or "").split()
+
+		problems = []
+		missing = {}
+		for layer, names in layercollections:
+			for c in names:
+				depends = LayerDependencyResolver.expand(variables.get("LAYERDEPENDS_%s" % c, ""), variables)
+				if depends == None:
+					self.environment.debug("Unable to expand LAYERDEPENDS_%s, not checked" % c)
+					depends = ""
+				for dep in LayerDependencyResolver.parseDepends(depends):
+					if dep[0] not in collections:
+						problems.append((layer, "depends on '%s' which is not provided by any layer" % dep[0]))
+						missing.setdefault(dep[0], []).append(layer)
+						continue
+					version = LayerDependencyResolver.expand(variables.get("LAYERVERSION_%s" % dep[0], ""), variables)
+					if dep[1] and version and version.strip().isdigit() and \
+							not LayerDependencyResolver.__compare__(int(version), dep[1]):
+						problems.append((layer, "depends on '%s' %s %d, but version %s is available" % (dep[0], dep[1][0], dep[1][1], version.strip())))
+
+				compat = LayerDependencyResolver.expand(variables.get("LAYERSERIES_COMPAT_%s" % c, ""), variables)
+				if compat == None:
+					self.environment.debug("Unable to expand LAYERSERIES_COMPAT_%s, not checked" % c)
+				elif compat.split() and len(corenames) != 0 and not set(compat.split()) & set(corenames):
+					problems.append((layer, "is not compatible with the core layer series %s (supports %s)" %
+							(" ".join(corenames), compat.strip())))
+		return (problems, missing)
+
+	@staticmethod
+	def __compare__(version, constraint):
+		if constraint[0] == ">=":
+			return version >= constraint[1]
+		elif constraint[0] == "<=":
+			return version <= constraint[1]
+		elif constraint[0] == ">":
+			return version > constraint[1]
+		elif constraint[0] == "<":
+			return version < constraint[1]
+		return version == constraint[1]
+
+	# Adds layers for the missing collections, found by the collection name or by the
+	# layer index dependencies of the layers which require them. Returns the layers
+	# added (which still need to be fetched).
+	def addMissing(self, missing):
+		added = []
+		for i in missing.iteritems():
+			candidates = [i[0]]
+			for layer in i[1]:
+				info = self.layers.search(layer.getName())
+				if info and "dependencies" in info:
+					candidates += [d[0] for d in info["dependencies"] if d[1]]
+
+			for name in candidates:
+				if self.layers.getLayer(name):
+					continue
+				try:
+					layer = self.layers.add(name)
+				except Exception:
+					layer = None
+				if layer:
+					self.environment.log("Adding layer '%s' for the missing dependency '%s'" % (layer.getName(), i[0]))
+					added.append(layer)
+					break
+		return added
+
+	# Checks the dependencies, the problems are reported as warnings unless fatal
+	def resolve(self, addmissing = False, fatal = False):
+		problems, missing = self.check()
+		if addmissing and len(missing) != 0:
+			added = self.addMissing(missing)
+			if len(added) != 0:
+				return added
+
+		if len(problems) != 0:
+			message = "Layer dependencies are not satisfied:"
+			for i in problems:
+				message += "\n    * '%s' %s" % (i[0].getName(), i[1])
+			if fatal:
+				raise Exception(message)
+			self.environment.warning(message)
+		return []
@@ -54,6 +54,8 @@ class ConfigurationGenerator:
 	def __init__(self, environment, config):
 		self.environment = environment
 		self.config = config
+		# conf -> changed variables (None for new confs) of the last generate
+		self.changed = {}
 
 	def generate(self, overwrite = True):
 		basepath = self.environment.getWorkingPath()
@@ -62,6 +64,13 @@ class ConfigurationGenerator:
 		if not os.path.isdir(confroot):
 			os.makedirs(confroot)
 
+		if self.environment.getDownloadMirrorUri():
+			self.environment.note("Using source mirror '%s'" % self.environment.getDownloadMirrorUri())
+		if not self.config.devmode:
+			self.environment.note("Applying standard build configuration optimizations")
+
+		# confs are only written if changed, keeping their mtime (and the bitbake parse cache) valid
+		self.changed = {}
 		conffiles = self.generateConfs()
 		for i in conffiles.iteritems():
 			confpath = os.path.join(confroot, i[0])
@@ -69,9 +78,23 @@ class ConfigurationGenerator:
 				self.environment.note("%s already exists, preserving it" % i[0])
 			else:
 				confdata = i[1].formatToStr()
-				self.environment.debug("Writing %s" % i[0])
-				with open(confpath, "w") as conffile:
-					conffile.write(confdata)
+				previous = None
+				if os.path.exists(confpath):
+					with open(confpath, "r") as conffile:
+						previous = conffile.read()
+
+				if previous == confdata:
+					self.environment.debug("%s is unchanged" % i[0])
+					continue
+
+				if previous == None:
+					self.environment.debug("Writing %s" % i[0])
+					self.changed[i[0]] = None
+				else:
+					changed = BBConfig.diffVariables(BBConfig.parseVariables(previous), BBConfig.parseVariables(confdata))
+					self.environment.note("%s changed (%s)" % (i[0], ", ".join(changed) if changed else "formatting only"))
+					self.changed[i[0]] = changed
+				hopper.utils.path.writeatomic(confpath, confdata)
 
 		return True
 
@@ -136,7 +159,6 @@ class ConfigurationGenerator:
 				#pconf["FETCHCMD_svn"] = "svn --config-option servers:global:http-proxy-host=%s --config-option servers:global:http-proxy-port=%s" % (proxy.getProxyHost(), proxy.getProxyPort())
 
 		if self.environment.getDownloadMirrorUri():
-			self.environment.note("Using source mirror '%s'" % self.environment.getDownloadMirrorUri())
 			with conf.section("Mirror") as mconf:
 				mconf.add("SOURCE_MIRROR_URL", "?=", self.environment.getDownloadMirrorUri())
 				mconf.add("INHERIT", "+=", "own-mirrors")
@@ -144,7 +166,6 @@ class ConfigurationGenerator:
 				mconf.add("BB_GENERATE_MIRROR_TARBALLS", "?=", "1")
 
 		if not self.config.devmode:
-			self.environment.note("Applying standard build configuration optimizations")
 			with conf.section("Optimization") as oconf:
 				oconf.add("INHERIT", "+=", "rm_work")
 
@@ -234,6 +255,30 @@ class BBConfig:
 	def formatRequire(value):
 		return "require %s" % value
 
+	# Parse conf data (as written by formatToStr) into var -> [(operator, value)],
+	# requires are included as 'require <path>'
+	@staticmethod
+	def parseVariables(data):
+		variables = {}
+		for i in data.replace("\\\n", " ").splitlines():
+			line = i.strip()
+			m = re.match("^require\\s+(.*)$", line)
+			if m:
+				variables.setdefault("require %s" % m.group(1), []).append(("require", m.group(1)))
+				continue
+			m = re.match("^(\\S+?)\\s*(\\?\\?=|\\?=|:=|\\+=|=\\+|\\.=|=\\.|=)\\s*\"(.*)\"$", line)
+			if m:
+				variables.setdefault(m.group(1), []).append((m.group(2), " ".join(m.group(3).split())))
+		return variables
+
+	@staticmethod
+	def diffVariables(old, new):
+		changed = []
+		for i in set(old.keys()) | set(new.keys()):
+			if old.get(i) != new.get(i):
+				changed.append(i)
+		return sorted(changed)
+
 	def formatToStr(self):
 		filedata = ""
 		for i in self.sections:
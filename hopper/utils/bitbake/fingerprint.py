@@ -0,0 +1,186 @@
+# Copyright (c) 2015 Xilinx Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import re
+import json
+import hashlib
+
+from hopper.utils.logger import *
+import hopper.source.meta
+import hopper.utils.git.refs
+import hopper.utils.git.refcache
+import hopper.utils.git.repo
+import hopper.utils.path
+import hopper.utils.bitbake.config
+
+# Fingerprint of everything a build depends on before bitbake is started (the
+# commits and order of the layers, the configuration, the confs that would be
+# generated and the confs on disk, and the bitbake version). If it matches the
+# last successful build the fetch and configuration steps can be skipped.
+#
+# The working trees of the layers are not part of the fingerprint, bitbake is
+# only skipped if all layers are clean git repositories (see isClean).
+class ConfigurationFingerprint:
+	filename = "hopper-fingerprint.json"
+	confs = ["bblayers.conf", "local.conf", "environment.conf"]
+
+	def __init__(self, environment, config):
+		self.environment = environment
+		self.config = config
+
+	def getPath(self):
+		return os.path.join(self.environment.getWorkingBuildPath(), ConfigurationFingerprint.filename)
+
+	# The commits of the layers (full name -> commit) read from the clones without
+	# running git, None if any cannot be determined. When the repositories are to
+	# be updated the commits must match the resolved ref cache.
+	def getCommits(self, forceupdate = False, refcachettl = None):
+		refcache = None
+		if forceupdate:
+			if not refcachettl:
+				return None
+			refcache = hopper.utils.git.refcache.ResolvedRefCache.getCache(self.environment, refcachettl)
+
+		heads = {}
+		commits = {}
+		for i in self.config.layers:
+			if not isinstance(i.source, hopper.source.meta.GitSource):
+				continue
+			path = i.getRootSourcePath(self.environment)
+			if path not in heads:
+				state = hopper.utils.git.refs.GitDirectory(path).readRefState() if path else None
+				heads[path] = state.head[1] if state and state.head else None
+			if not heads[path]:
+				return None
+			if refcache and refcache.get(i.source.remote, i.source.ref) != heads[path]:
+				return None
+			commits[i.getFullName()] = heads[path]
+		return commits
+
+	def getBitBakeVersion(self):
+		for i in self.config.layers:
+			sourcepath = i.getSourcePath(self.environment)
+			if i.isBitBake():
+				bitbakedir = sourcepath
+			elif i.getName() == "poky":
+				bitbakedir = os.path.join(sourcepath, "bitbake")
+			else:
+				continue
+
+			try:
+				with open(os.path.join(bitbakedir, "lib", "bb", "__init__.py"), "r") as f:
+					for line in f:
+						m = re.match("^__version__\\s*=\\s*[\"'](.*)[\"']", line)
+						if m:
+							return m.group(1)
+			except (IOError, OSError, TypeError):
+				pass
+		return None
+
+	# Calculate the fingerprint, None if the layers or confs are not available
+	def calculate(self, forceupdate = False, fetchoptions = None):
+		commits = self.getCommits(forceupdate, fetchoptions.refcachettl if fetchoptions else None)
+		if commits == None:
+			return None
+
+		m = hashlib.sha1()
+		m.update("layers:%s\n" % self.config.layers.hash(commits))
+		# the order of the layers is significant (BBLAYERS)
+		m.update("order:%s\n" % " ".join(i.getFullName() for i in self.config.layers))
+		m.update("bitbake:%s\n" % self.getBitBakeVersion())
+		m.update("machine:%s\n" % self.config.machine)
+		m.update("distro:%s\n" % self.config.distro)
+		m.update("vars:%s\n" % repr(self.config.vars))
+		m.update("threads:%s\n" % self.config.threadLimit)
+		m.update("devmode:%s hopperenv:%s\n" % (self.config.devmode, self.config.hopperEnv))
+		m.update("proxy:%s\n" % (self.environment.getProxy() != None))
+		m.update("mirror:%s\n" % self.environment.getDownloadMirrorUri())
+		if fetchoptions:
+			m.update("fetch:%s\n" % repr((fetchoptions.depth, fetchoptions.filter, fetchoptions.worktree,
+					fetchoptions.sparse, fetchoptions.untrackedcache, fetchoptions.fsmonitor)))
+
+		# the confs this run would generate, and the confs on disk (e.g. a preserved local.conf)
+		generator = hopper.utils.bitbake.config.ConfigurationGenerator(self.environment, self.config)
+		conffiles = generator.generateConfs()
+		confroot = os.path.join(self.environment.getWorkingPath(), "conf")
+		for i in ConfigurationFingerprint.confs:
+			m.update("generated %s:%s\n" % (i, hashlib.sha1(conffiles[i].formatToStr()).hexdigest()))
+			try:
+				with open(os.path.join(confroot, i), "r") as f:
+					m.update("%s:%s\n" % (i, hashlib.sha1(f.read()).hexdigest()))
+			except (IOError, OSError):
+				return None
+		return m.hexdigest()
+
+	# Whether the working trees of all layers are unchanged from their commits, local
+	# layers and repositories with local changes may differ without any commit changing
+	def isClean(self):
+		checked = set()
+		for i in self.config.layers:
+			if isinstance(i.source, hopper.source.meta.LocalSource):
+				self.environment.debug("Layer '%s' is a local layer" % i.getName())
+				return False
+			if not isinstance(i.source, hopper.source.meta.GitSource):
+				continue
+			path = i.getRootSourcePath(self.environment)
+			if path in checked:
+				continue
+			checked.add(path)
+			gitrepo = hopper.utils.git.repo.Repository(self.environment, path)
+			dirty = gitrepo.dirty()
+			gitrepo.close()
+			if dirty:
+				self.environment.debug("Repository '%s' has local changes" % path)
+				return False
+		return True
+
+	def read(self):
+		try:
+			with open(self.getPath(), "r") as f:
+				data = json.load(f)
+			if isinstance(data, dict):
+				return data
+		except (IOError, OSError, ValueError):
+			pass
+		return None
+
+	def matches(self, fingerprint, targets):
+		if fingerprint == None:
+			return False
+		last = self.read()
+		if not last:
+			return False
+		return last.get("fingerprint") == fingerprint and last.get("targets") == list(targets or [])
+
+	# record the fingerprint of a successful build
+	def write(self, fingerprint, targets):
+		path = self.getPath()
+		if fingerprint == None:
+			self.clear()
+			return
+		if not os.path.exists(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		hopper.utils.path.writeatomic(path, json.dumps({"fingerprint" : fingerprint, "targets" : list(targets or [])}))
+
+	def clear(self):
+		if os.path.exists(self.getPath()):
+			os.remove(self.getPath())
@@ -0,0 +1,163 @@
+# Copyright (c) 2015 Xilinx Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import re
+import json
+import time
+
+from hopper.utils.logger import *
+import hopper.utils.git.repo
+from hopper.utils.git.refs import GitDirectory
+
+# A directory of git bundles, exports are incremental (relative to a previous
+# manifest) and named '<repository>-<timestamp>.bundle' so that the bundles of
+# several exports can be collected in a single directory and applied in order.
+class BundleStore:
+	appliedname = "hopper-bundles"
+
+	def __init__(self, environment, path):
+		self.environment = environment
+		self.path = path
+
+	def getBundles(self, clonename):
+		bundles = []
+		if os.path.isdir(self.path):
+			pattern = re.compile("^%s-[0-9]+\\.bundle$" % re.escape(clonename))
+			for i in sorted(os.listdir(self.path)):
+				if pattern.match(i):
+					bundles.append(i)
+		return bundles
+
+	@staticmethod
+	def readManifest(path):
+		with open(path, "r") as f:
+			return json.load(f)
+
+	def writeManifest(self, stamp, repositories):
+		path = os.path.join(self.path, "manifest-%s.json" % stamp)
+		with open(path, "w") as f:
+			json.dump({"created" : stamp, "repositories" : repositories}, f, indent = 1, sort_keys = True)
+		return path
+
+	@staticmethod
+	def getStamp():
+		return time.strftime("%Y%m%d%H%M%S", time.gmtime())
+
+	# Export the checked out commit of the repository (named by the ref if possible),
+	# only including the objects that are not reachable from the 'since' commit
+	def export(self, gitrepo, clonename, remote, ref, stamp, since = None):
+		head = gitrepo.getTreeRef()
+		if not head:
+			raise Exception("Unable to determine the commit of '%s'" % clonename)
+		commit = head[1]
+
+		entry = {"remote" : remote, "ref" : ref, "commit" : commit, "bundle" : None, "since" : None}
+		if since == commit:
+			self.environment.log("%s: No changes since the previous export" % clonename)
+			return entry
+
+		# HEAD allows a clone of the bundle to checkout the commit
+		revisions = ["HEAD"]
+		for i in ["refs/tags/%s" % ref, "refs/heads/%s" % ref]:
+			if gitrepo.getRefCommit(i) and gitrepo.getPeeledCommit(i) == commit:
+				revisions.append(i)
+				break
+		if since and gitrepo.absoluteSHA(since):
+			revisions.append("^%s" % since)
+			entry["since"] = since
+
+		if not os.path.exists(self.path):
+			os.makedirs(self.path)
+		filename = "%s-%s.bundle" % (clonename, stamp)
+		self.environment.log("%s: Exporting %s to '%s'" % (clonename, " ".join(revisions), filename))
+		if not gitrepo.createBundle(os.path.join(self.path, filename), revisions):
+			raise Exception("Failed to create bundle for '%s'" % clonename)
+		entry["bundle"] = filename
+		return entry
+
+	def __getAppliedPath__(self, gitrepo):
+		gitdir = GitDirectory(gitrepo.getPath())
+		if gitdir.locate():
+			return os.path.join(gitdir.gitdir, BundleStore.appliedname)
+		return None
+
+	def getApplied(self, gitrepo):
+		path = self.__getAppliedPath__(gitrepo)
+		if path and os.path.isfile(path):
+			with open(path, "r") as f:
+				return [i.strip() for i in f.readlines() if len(i.strip()) != 0]
+		return []
+
+	def __markApplied__(self, gitrepo, bundle):
+		path = self.__getAppliedPath__(gitrepo)
+		if path:
+			with open(path, "a") as f:
+				f.write("%s\n" % bundle)
+
+	# Clone the repository from the bundles (the first must be a complete bundle),
+	# the remote is then set to the real remote
+	def clone(self, gitrepo, clonename, remote, checkout = True):
+		bundles = self.getBundles(clonename)
+		if len(bundles) == 0:
+			return False
+
+		self.environment.log("%s: Cloning from bundle '%s'" % (clonename, bundles[0]))
+		try:
+			gitrepo.clone(os.path.join(self.path, bundles[0]), overwrite = True, checkout = checkout)
+		except Exception as e:
+			self.environment.warning("%s: Failed to clone from bundle, %s" % (clonename, e))
+			return False
+		gitrepo.setRemoteUrl("origin", remote)
+		self.__markApplied__(gitrepo, bundles[0])
+		return True
+
+	# Fetch the bundles which have not been applied to the repository, bundles whose
+	# prerequisites are missing are skipped. Returns whether any were applied.
+	def apply(self, gitrepo, clonename, remotename):
+		fetched = False
+		applied = self.getApplied(gitrepo)
+		for i in self.getBundles(clonename):
+			if i in applied:
+				continue
+
+			path = os.path.join(self.path, i)
+			refs = gitrepo.listBundle(path)
+			if refs == None:
+				self.environment.warning("%s: Unable to read bundle '%s'" % (clonename, i))
+				continue
+
+			refspecs = []
+			for r in sorted(refs.iterkeys()):
+				if r.startswith("refs/heads/"):
+					refspecs.append("+%s:refs/remotes/%s/%s" % (r, remotename, r[len("refs/heads/"):]))
+				elif r.startswith("refs/tags/"):
+					refspecs.append("+%s:%s" % (r, r))
+				else:
+					refspecs.append(r)
+
+			self.environment.log("%s: Fetching from bundle '%s'" % (clonename, i))
+			if not gitrepo.fetch(path, refspecs, tags = False):
+				self.environment.warning("%s: Failed to fetch from bundle '%s'" % (clonename, i))
+				continue
+			self.__markApplied__(gitrepo, i)
+			fetched = True
+		return fetched
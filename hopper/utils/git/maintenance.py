@@ -0,0 +1,121 @@
+# Copyright (c) 2015 Xilinx Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import time
+
+from hopper.utils.logger import *
+import hopper.utils.tasks
+import hopper.utils.git.repo
+import hopper.utils.git.mirror
+import hopper.source.fetcher
+from hopper.utils.git.refs import GitDirectory
+
+# Repacks, packs refs, writes the commit-graph/multi-pack-index and prunes the
+# workspace clones and mirrors. Each repository is maintained at most once per
+# interval, and repositories which are locked (e.g. being fetched) are skipped.
+#
+# Mirrors are the alternates of the workspace clones and worktrees, objects which
+# are unreachable in a mirror may still be used by a workspace, so mirrors are
+# not pruned.
+class MaintenanceTask(hopper.utils.tasks.TaskBase):
+	stampname = "hopper-maintenance"
+
+	def __init__(self, environment, interval = 86400, force = False):
+		hopper.utils.tasks.TaskBase.__init__(self, environment)
+		self.interval = interval
+		self.force = force
+
+	def __repr__(self):
+		return "Repository Maintenance"
+
+	def getRepositories(self):
+		repos = []
+
+		sources = self.environment.getWorkingSourcesPath()
+		if os.path.isdir(sources):
+			for i in sorted(os.listdir(sources)):
+				path = os.path.join(sources, i)
+				# worktrees share the objects of the mirror, the mirror is maintained instead
+				if os.path.isdir(os.path.join(path, ".git")):
+					lock = hopper.source.fetcher.LayerFetchGitTask.getLock(self.environment, i)
+					repos.append((path, lock, True))
+
+		mirror = hopper.utils.git.mirror.MirrorStore(self.environment)
+		if mirror.enabled() and os.path.isdir(mirror.path):
+			for i in sorted(os.listdir(mirror.path)):
+				path = os.path.join(mirror.path, i)
+				if i.endswith(".git") and os.path.isdir(path):
+					repos.append((path, mirror.getPathLock(path), False))
+
+		return repos
+
+	def isDue(self, gitdir):
+		try:
+			age = time.time() - os.path.getmtime(os.path.join(gitdir, MaintenanceTask.stampname))
+			return age >= self.interval
+		except OSError:
+			return True
+
+	def execute(self, handler = None):
+		maintained = 0
+		for i in self.getRepositories():
+			if self.maintain(i[0], i[1], i[2]):
+				maintained += 1
+		self.environment.log("Maintained %d repositories" % maintained)
+		return True
+
+	def maintain(self, path, lock, prune = True):
+		gitdir = GitDirectory(path)
+		if not gitdir.locate():
+			return False
+		if not self.force and not self.isDue(gitdir.commondir):
+			self.environment.debug("Skipping maintenance of '%s', maintained recently" % path)
+			return False
+
+		if not lock.acquire(blocking = False):
+			self.environment.log("Skipping maintenance of '%s', it is in use" % path)
+			return False
+		try:
+			# git may be operating on the repository outside of hopper
+			for i in ["index.lock", "packed-refs.lock", "shallow.lock", "HEAD.lock"]:
+				if os.path.exists(os.path.join(gitdir.commondir, i)):
+					self.environment.log("Skipping maintenance of '%s', it is in use by git" % path)
+					return False
+
+			self.environment.log("Maintaining '%s'" % path)
+			repo = hopper.utils.git.repo.Repository(self.environment, path)
+			steps = [("repack", repo.repack),
+					("pack-refs", repo.packRefs),
+					("commit-graph", repo.writeCommitGraph),
+					("multi-pack-index", repo.writeMultiPackIndex)]
+			if prune:
+				steps.append(("prune", repo.prune))
+			for i in steps:
+				if not i[1]():
+					self.environment.warning("Maintenance step '%s' failed for '%s'" % (i[0], path))
+			repo.close()
+
+			with open(os.path.join(gitdir.commondir, MaintenanceTask.stampname), "w") as f:
+				f.write("%d\n" % time.time())
+			return True
+		finally:
+			lock.release()
@@ -0,0 +1,167 @@
+# Copyright (c) 2015 Xilinx Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import re
+import shutil
+import hashlib
+import threading
+
+from hopper.utils.logger import *
+import hopper.utils.lock
+import hopper.utils.git.repo
+from hopper.utils.git.refs import GitDirectory
+
+# Manages the bare '--mirror' clones in the environments source mirror. Mirrors are
+# created on first use and refreshed incrementally, workspaces are then cloned and
+# fetched from the mirror instead of the remote. Workspaces share the objects of
+# the mirror, so mirrors are never pruned.
+#
+# Mirrors are refreshed at most once per invocation (e.g. one build), the mirrors
+# refreshed are tracked by the environment (see Environment.refreshedmirrors).
+class MirrorStore:
+	refreshedlock = threading.RLock()
+
+	def __init__(self, environment):
+		self.environment = environment
+		self.path = environment.getSourceMirror() if environment else None
+
+	def enabled(self):
+		if not self.path:
+			return False
+		if os.path.isdir(self.path):
+			return os.access(self.path, os.W_OK)
+		parent = os.path.dirname(os.path.abspath(self.path))
+		return os.path.isdir(parent) and os.access(parent, os.W_OK)
+
+	# Mirrors are keyed by the full remote url (remotes with the same repository
+	# name, e.g. forks, have separate mirrors), the repository name is kept readable
+	@staticmethod
+	def getMirrorName(remote):
+		clonename = hopper.utils.git.repo.getUriRepositoryName(remote)
+		clonename = re.sub("[^A-Za-z0-9._\\-]", "_", clonename)
+		return "%s-%s" % (clonename, hashlib.sha1(remote).hexdigest()[0:12])
+
+	def getMirrorPath(self, remote):
+		return os.path.join(self.path, MirrorStore.getMirrorName(remote) + ".git")
+
+	# Exclusive while the mirror is modified, shared while it is read (cloned or
+	# fetched from) by workspaces
+	def getLock(self, remote, shared = False):
+		return MirrorStore.getPathLock(self.getMirrorPath(remote), shared)
+
+	@staticmethod
+	def getPathLock(path, shared = False):
+		if path.endswith(".git"):
+			path = path[0:len(path) - len(".git")]
+		return hopper.utils.lock.FileLock(path + ".lock", shared)
+
+	def getRepository(self, remote):
+		return hopper.utils.git.repo.Repository(self.environment, self.getMirrorPath(remote))
+
+	# whether the mirror exists and is a mirror of the remote
+	def isManaged(self, remote):
+		path = self.getMirrorPath(remote)
+		if os.path.isdir(path):
+			config = GitDirectory(path).readConfig()
+			if config != None:
+				url = GitDirectory.getConfigValue(config, "remote", "origin", "url")
+				mirror = GitDirectory.getConfigValue(config, "remote", "origin", "mirror")
+				return url == remote and mirror == "true"
+		return False
+
+	# Ensures that the mirror exists, and if requested that it is up to date with the
+	# remote. Returns the path to the mirror or None if the mirror cannot be used.
+	def prepare(self, remote, refresh = False):
+		if not self.enabled():
+			return None
+
+		path = self.getMirrorPath(remote)
+		with self.getLock(remote):
+			if not os.path.exists(path):
+				self.environment.log("Creating mirror of '%s'" % remote)
+				# clone to a temporary location, the mirror only appears once complete
+				temppath = path + ".tmp"
+				if os.path.exists(temppath):
+					shutil.rmtree(temppath)
+				tempmirror = hopper.utils.git.repo.Repository(self.environment, temppath)
+				tempmirror.clone(remote, mirror = True)
+				# workspaces use the objects of the mirror (alternates), objects which become
+				# unreachable in the mirror (force pushes, deleted branches) must be kept
+				tempmirror.setConfig("gc.pruneExpire", "never")
+				os.rename(temppath, path)
+				self.__markRefreshed__(path)
+				return path
+
+			if not self.isManaged(remote):
+				self.environment.warning("Mirror '%s' is not a mirror of '%s', not using it" % (path, remote))
+				return None
+
+			if refresh and not self.__isRefreshed__(path):
+				self.environment.log("Updating mirror of '%s'" % remote)
+				repo = hopper.utils.git.repo.Repository(self.environment, path)
+				if not repo.fetch("origin", prune = True):
+					raise Exception("Failed to update mirror '%s'" % path)
+				self.__markRefreshed__(path)
+		return path
+
+	# Fetches the refs (or all refs) from the remote into the mirror, regardless of
+	# whether it has already been refreshed. Returns the path to the mirror or None
+	# if the mirror cannot be used.
+	def update(self, remote, refs = None):
+		path = self.prepare(remote)
+		if not path:
+			return None
+
+		with self.getLock(remote):
+			repo = hopper.utils.git.repo.Repository(self.environment, path)
+			if refs:
+				refspecs = ["+%s:%s" % (i, i) for i in refs]
+				if repo.fetch("origin", refspecs, tags = False):
+					return path
+				# refs which no longer exist fail the fetch, fall back to updating everything
+				self.environment.debug("Failed to fetch %s into mirror '%s'" % (refs, path))
+
+			if not repo.fetch("origin", prune = True):
+				raise Exception("Failed to update mirror '%s'" % path)
+			self.__markRefreshed__(path)
+		return path
+
+	# whether the path is a worktree of the mirror of the remote
+	def isWorktree(self, remote, path):
+		gitdir = GitDirectory(path)
+		if os.path.isfile(os.path.join(path, ".git")) and gitdir.locate():
+			return os.path.realpath(gitdir.commondir) == os.path.realpath(self.getMirrorPath(remote))
+		return False
+
+	def __isRefreshed__(self, path):
+		refreshed = self.environment.refreshedmirrors
+		if refreshed == None:
+			return False
+		with MirrorStore.refreshedlock:
+			return path in refreshed
+
+	def __markRefreshed__(self, path):
+		refreshed = self.environment.refreshedmirrors
+		if refreshed == None:
+			return
+		with MirrorStore.refreshedlock:
+			refreshed.add(path)
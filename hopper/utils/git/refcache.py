@@ -0,0 +1,86 @@
+# Copyright (c) 2015 Xilinx Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import json
+import time
+import threading
+
+from hopper.utils.logger import *
+import hopper.utils.lock
+import hopper.utils.path
+
+# On disk cache of the commits that remote refs were last resolved to, allows the
+# remote to be skipped if the ref was resolved recently (within the ttl)
+class ResolvedRefCache:
+	filename = "resolved-refs.json"
+	lock = threading.RLock()
+
+	def __init__(self, path, ttl = None):
+		self.path = path
+		self.ttl = ttl
+		self.entries = None
+
+	@staticmethod
+	def getCache(environment, ttl = None):
+		# share the cache between build directories if a mirror is available
+		import hopper.utils.git.mirror
+		mirror = hopper.utils.git.mirror.MirrorStore(environment)
+		if mirror.enabled():
+			root = mirror.path
+		else:
+			root = environment.getWorkingSourcesPath()
+		return ResolvedRefCache(os.path.join(root, ResolvedRefCache.filename), ttl)
+
+	@staticmethod
+	def __key__(remote, ref):
+		return "%s %s" % (remote, ref)
+
+	def __read__(self):
+		try:
+			with open(self.path, "r") as f:
+				entries = json.load(f)
+			if isinstance(entries, dict):
+				return entries
+		except (IOError, OSError, ValueError):
+			pass
+		return {}
+
+	def get(self, remote, ref):
+		if not self.ttl or self.ttl <= 0:
+			return None
+
+		if self.entries == None:
+			self.entries = self.__read__()
+		entry = self.entries.get(ResolvedRefCache.__key__(remote, ref))
+		if entry and (time.time() - entry.get("time", 0)) <= self.ttl:
+			return entry.get("commit")
+		return None
+
+	def set(self, remote, ref, commit):
+		with ResolvedRefCache.lock:
+			with hopper.utils.lock.FileLock(self.path + ".lock"):
+				# merge with entries written by others
+				entries = self.__read__()
+				entries[ResolvedRefCache.__key__(remote, ref)] = {"commit" : commit, "time" : time.time()}
+
+				hopper.utils.path.writeatomic(self.path, json.dumps(entries, indent = 1, sort_keys = True))
+				self.entries = entries
@@ -0,0 +1,340 @@
+# Copyright (c) 2015 Xilinx Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import re
+
+# Snapshot of the refs of a repository, allows the ref queries to be answered
+# without executing git for each query
+class RefState:
+	def __init__(self):
+		self.refs = {} # refname -> object
+		self.peeled = {} # refname -> peeled commit (annotated tags)
+		self.upstreams = {} # local branch -> upstream refname
+		self.head = None # (symbolic ref or None, commit)
+
+	@staticmethod
+	def getCandidates(name):
+		# the same lookup order used by git when resolving a short ref name
+		return [name,
+				"refs/%s" % name,
+				"refs/tags/%s" % name,
+				"refs/heads/%s" % name,
+				"refs/remotes/%s" % name,
+				"refs/remotes/%s/HEAD" % name]
+
+	def resolve(self, name):
+		if name == "HEAD":
+			if self.head and self.head[0]:
+				return self.head[0]
+			return None
+		for i in RefState.getCandidates(name):
+			if i in self.refs:
+				return i
+		return None
+
+	def match(self, pattern):
+		# matches the behaviour of 'git show-ref <pattern>'
+		matches = []
+		for i in sorted(self.refs.iterkeys()):
+			if i == pattern or i.endswith("/" + pattern):
+				matches.append(i)
+		return matches
+
+	def getCommit(self, ref):
+		matches = self.match(ref)
+		if len(matches) != 0:
+			return self.refs[matches[0]]
+		return None
+
+	def getTracking(self, upstream):
+		for i in sorted(self.upstreams.iterkeys()):
+			if self.upstreams[i] == upstream:
+				return i
+		return None
+
+	@staticmethod
+	def shortName(ref):
+		for i in ["refs/heads/", "refs/tags/", "refs/remotes/"]:
+			if ref.startswith(i):
+				return ref[len(i):]
+		if ref.startswith("refs/"):
+			return ref[len("refs/"):]
+		return ref
+
+# Reads the refs, HEAD and config directly from a repositories git directory. Any
+# case which cannot be handled reliably returns None so that the caller can fall
+# back to querying git.
+class GitDirectory:
+	shapattern = re.compile("^[0-9a-f]{40}$")
+
+	def __init__(self, path):
+		self.path = path
+		self.gitdir = None
+		self.commondir = None
+
+	def locate(self):
+		if self.gitdir:
+			return True
+
+		gitdir = None
+		dotgit = os.path.join(self.path, ".git")
+		if os.path.isdir(dotgit):
+			gitdir = dotgit
+		elif os.path.isfile(dotgit):
+			# worktrees and submodules use a 'gitdir: <path>' file
+			content = GitDirectory.__readfile__(dotgit)
+			if content and content.startswith("gitdir:"):
+				gitdir = os.path.join(self.path, content[len("gitdir:"):].strip())
+		elif os.path.isfile(os.path.join(self.path, "HEAD")):
+			# bare repository
+			gitdir = self.path
+
+		if not gitdir or not os.path.isfile(os.path.join(gitdir, "HEAD")):
+			return False
+
+		commondir = gitdir
+		content = GitDirectory.__readfile__(os.path.join(gitdir, "commondir"))
+		if content:
+			commondir = os.path.normpath(os.path.join(gitdir, content.strip()))
+
+		self.gitdir = gitdir
+		self.commondir = commondir
+		return True
+
+	@staticmethod
+	def __readfile__(path):
+		try:
+			with open(path, "r") as f:
+				return f.read()
+		except (IOError, OSError):
+			return None
+
+	def readConfig(self, worktree = False):
+		if not self.locate():
+			return None
+
+		content = GitDirectory.__readfile__(os.path.join(self.commondir, "config"))
+		if content == None:
+			return None
+		if worktree:
+			# per worktree config overrides the common config
+			worktreecontent = GitDirectory.__readfile__(os.path.join(self.gitdir, "config.worktree"))
+			if worktreecontent:
+				content += "\n" + worktreecontent
+
+		config = {}
+		section = None
+		for i in content.splitlines():
+			line = i.strip()
+			if len(line) == 0 or line[0] in "#;":
+				continue
+
+			m = re.match("^\\[\\s*([^\\s\\]\"]+)\\s*(?:\"(.*)\")?\\s*\\]$", line)
+			if m:
+				section = (m.group(1).lower(), m.group(2))
+				if section[0] == "include" or section[0] == "includeif":
+					# included config files are not supported
+					return None
+				if section not in config:
+					config[section] = {}
+				continue
+
+			if section == None:
+				return None
+
+			parts = line.split("=", 1)
+			key = parts[0].strip().lower()
+			value = "true"
+			if len(parts) > 1:
+				value = parts[1].strip()
+				if value.startswith("\"") and value.endswith("\"") and len(value) >= 2:
+					value = value[1:-1]
+			config[section].setdefault(key, []).append(value)
+		return config
+
+	@staticmethod
+	def getConfigValue(config, section, subsection, key):
+		values = config.get((section, subsection), {}).get(key)
+		if values:
+			return values[-1]
+		return None
+
+	@staticmethod
+	def getConfigBool(config, section, subsection, key):
+		value = GitDirectory.getConfigValue(config, section, subsection, key)
+		if value and value.lower() in ["true", "yes", "on", "1"]:
+			return True
+		return False
+
+	# Returns the directories of a cone mode sparse checkout, an empty list if the
+	# checkout is not sparse or None if it cannot be determined
+	def readSparseCheckout(self):
+		config = self.readConfig(worktree = True)
+		if config == None:
+			return None
+		if not GitDirectory.getConfigBool(config, "core", None, "sparsecheckout"):
+			return []
+		if not GitDirectory.getConfigBool(config, "core", None, "sparsecheckoutcone"):
+			return None
+
+		content = GitDirectory.__readfile__(os.path.join(self.gitdir, "info", "sparse-checkout"))
+		if content == None:
+			return None
+		lines = [i.strip() for i in content.splitlines()]
+		directories = []
+		for i in lines:
+			# recursive directories are the ones which do not exclude their subdirectories
+			if i.startswith("/") and i.endswith("/") and i != "/" and ("!%s*/" % i) not in lines:
+				directories.append(i.strip("/"))
+		return sorted(directories)
+
+	# The global/system config files git reads in addition to the repository config
+	@staticmethod
+	def getUserConfigPaths():
+		home = os.path.expanduser("~")
+		paths = []
+		if "GIT_CONFIG_GLOBAL" in os.environ:
+			paths.append(os.environ["GIT_CONFIG_GLOBAL"])
+		else:
+			xdg = os.environ.get("XDG_CONFIG_HOME") or os.path.join(home, ".config")
+			paths.append(os.path.join(xdg, "git", "config"))
+			paths.append(os.path.join(home, ".gitconfig"))
+		if not os.environ.get("GIT_CONFIG_NOSYSTEM"):
+			paths.append(os.environ.get("GIT_CONFIG_SYSTEM", "/etc/gitconfig"))
+		return paths
+
+	# Whether the url rewriting (url.<base>.insteadOf) of the global/system config
+	# (or the config passed via the environment) may apply, includes are assumed to
+	# contain rewrites
+	@staticmethod
+	def hasUserUrlRewrites():
+		if "GIT_CONFIG_PARAMETERS" in os.environ or "GIT_CONFIG_COUNT" in os.environ:
+			return True
+		for i in GitDirectory.getUserConfigPaths():
+			content = GitDirectory.__readfile__(i)
+			if content and re.search("^\\s*\\[\\s*(url|include|includeif)[\\s\\]\"]", content, re.I | re.M):
+				return True
+		return False
+
+	# The remote urls as git reports them, None if url rewriting applies (which
+	# cannot be handled here)
+	def getRemotes(self):
+		config = self.readConfig()
+		if config == None:
+			return None
+		if GitDirectory.hasUserUrlRewrites():
+			return None
+
+		remotes = {}
+		for i in config.iteritems():
+			if i[0][0] == "url":
+				# url rewriting is applied by git, cannot be handled here
+				return None
+			if i[0][0] == "remote" and i[0][1] != None and "url" in i[1]:
+				remotes[i[0][1]] = i[1]["url"][0]
+		return remotes
+
+	def readRefState(self):
+		if not self.locate():
+			return None
+
+		config = self.readConfig()
+		if config == None:
+			return None
+		if GitDirectory.getConfigValue(config, "extensions", None, "refstorage") not in [None, "files"]:
+			return None
+
+		state = RefState()
+		symbolic = {}
+
+		# packed refs
+		content = GitDirectory.__readfile__(os.path.join(self.commondir, "packed-refs"))
+		if content:
+			lastref = None
+			for i in content.splitlines():
+				if i.startswith("#"):
+					continue
+				elif i.startswith("^"):
+					if lastref:
+						state.peeled[lastref] = i[1:].strip()
+					continue
+				parts = i.split(" ", 1)
+				if len(parts) != 2 or not GitDirectory.shapattern.match(parts[0]):
+					return None
+				lastref = parts[1].strip()
+				state.refs[lastref] = parts[0]
+
+		# loose refs (override packed refs)
+		refsroot = os.path.join(self.commondir, "refs")
+		for root, dirs, files in os.walk(refsroot):
+			for f in files:
+				if f.endswith(".lock"):
+					continue
+				fullpath = os.path.join(root, f)
+				refname = "refs/" + os.path.relpath(fullpath, refsroot).replace(os.sep, "/")
+				content = GitDirectory.__readfile__(fullpath)
+				if content == None:
+					return None
+				content = content.strip()
+				if content.startswith("ref:"):
+					symbolic[refname] = content[len("ref:"):].strip()
+				elif GitDirectory.shapattern.match(content):
+					state.refs[refname] = content
+					if refname in state.peeled:
+						# the packed peeled value belongs to the old value
+						del state.peeled[refname]
+				else:
+					return None
+
+		for i in symbolic.iteritems():
+			if i[1] in state.refs:
+				state.refs[i[0]] = state.refs[i[1]]
+
+		# upstreams of local branches
+		for i in config.iteritems():
+			if i[0][0] == "branch" and i[0][1] != None:
+				remote = GitDirectory.getConfigValue(config, "branch", i[0][1], "remote")
+				merge = GitDirectory.getConfigValue(config, "branch", i[0][1], "merge")
+				if remote and merge:
+					if remote == ".":
+						upstream = merge
+					elif merge.startswith("refs/heads/"):
+						upstream = "refs/remotes/%s/%s" % (remote, merge[len("refs/heads/"):])
+					else:
+						continue
+					state.upstreams["refs/heads/%s" % i[0][1]] = upstream
+
+		# HEAD
+		content = GitDirectory.__readfile__(os.path.join(self.gitdir, "HEAD"))
+		if content == None:
+			return None
+		content = content.strip()
+		if content.startswith("ref:"):
+			headref = content[len("ref:"):].strip()
+			if headref in state.refs:
+				state.head = (headref, state.refs[headref])
+		elif GitDirectory.shapattern.match(content):
+			state.head = (None, content)
+		else:
+			return None
+
+		return state
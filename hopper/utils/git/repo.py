@@ -20,11 +20,13 @@
 
 
 import os
+import re
 import urlparse
 import shutil
 
 from hopper.utils.logger import *
 import hopper.utils.git.tasks
+from hopper.utils.git.refs import RefState, GitDirectory
 
 def getUriRepositoryName(uri):
 	url = urlparse.urlparse(uri)
@@ -70,12 +72,69 @@ class Repository:
 		self.environment = environment
 		self.path = path
 
+		# cached repository state, see invalidate()
+		self.refstate = None
+		self.remotes = None
+		self.objectquery = None
+
 	def getPath(self):
 		return self.path
 
 	def __git__(self, command):
 		return hopper.utils.git.tasks.GitTask.run(command, path = self.path, environment = self.environment)
 
+	def __query__(self, name):
+		if not self.objectquery:
+			self.objectquery = hopper.utils.git.tasks.GitObjectQuery(self.environment, self.path)
+		return self.objectquery.query(name)
+
+	def close(self):
+		if self.objectquery:
+			self.objectquery.close()
+			self.objectquery = None
+
+	# Drop the cached refs/remotes, must be called after anything modifies the repository
+	def invalidate(self, remotes = False):
+		self.refstate = None
+		if remotes:
+			self.remotes = None
+
+	def getRefState(self):
+		if self.refstate == None:
+			self.refstate = self.__readRefState__()
+		return self.refstate
+
+	def __readRefState__(self):
+		# read the refs directly where possible, avoids executing git at all
+		state = GitDirectory(self.path).readRefState()
+		if state != None:
+			return state
+
+		result = self.__git__(["for-each-ref",
+				"--format=%(objectname) %(*objectname) %(refname) %(upstream) %(HEAD)"])
+		if result[0] != 0:
+			return None
+
+		state = RefState()
+		for i in result[1].splitlines():
+			parts = i.split(" ")
+			if len(parts) < 5:
+				continue
+			state.refs[parts[2]] = parts[0]
+			if len(parts[1]) != 0:
+				state.peeled[parts[2]] = parts[1]
+			if len(parts[3]) != 0:
+				state.upstreams[parts[2]] = parts[3]
+			if parts[4] == "*":
+				state.head = (parts[2], parts[0])
+
+		if state.head == None:
+			# detached HEAD (or no commits)
+			head = self.__query__("HEAD")
+			if head:
+				state.head = (None, head[0])
+		return state
+
 	def valid(self):
 		if os.path.exists(self.path) and os.path.isdir(self.path):
 			if os.path.exists(os.path.join(self.path, ".git")):
@@ -87,35 +146,85 @@ class Repository:
 		return False
 
 	def dirty(self, untracked = True):
-		status = self.getStatus()
-		if status:
-			if len(status[0]) != 0 or len(status[1]) != 0:
-				return True
-			if untracked and len(status[2]) != 0:
+		# refresh the stat info of the index so that touched files are not reported
+		self.__git__(["update-index", "-q", "--refresh"])
+		result = self.__git__(["diff-index", "--quiet", "HEAD", "--"])
+		if result[0] == 1:
+			return True
+		elif result[0] != 0:
+			# e.g. no commit checked out, fall back to the full status
+			status = self.getStatus()
+			if status:
+				if len(status[0]) != 0 or len(status[1]) != 0:
+					return True
+				if untracked and len(status[2]) != 0:
+					return True
+			return False
+
+		if untracked:
+			# the same directory listing as status, allowing the untracked cache to be used
+			result = self.__git__(["ls-files", "--others", "--exclude-standard", "--directory", "--no-empty-directory"])
+			if result[0] == 0 and len(result[1].strip()) != 0:
 				return True
 		return False
 
+	# Enables the untracked cache and/or a fsmonitor (e.g. 'true' or a hook) so that
+	# dirty/status checks do not need to scan the entire working tree
+	def setStatusCache(self, untrackedcache = True, fsmonitor = None):
+		config = GitDirectory(self.path).readConfig()
+		def current(key):
+			if config != None:
+				return GitDirectory.getConfigValue(config, "core", None, key)
+			return None
+
+		if untrackedcache and current("untrackedcache") != "true":
+			if self.__git__(["config", "core.untrackedCache", "true"])[0] != 0:
+				return False
+			self.__git__(["update-index", "--untracked-cache"])
+		if fsmonitor and current("fsmonitor") != fsmonitor:
+			if self.__git__(["config", "core.fsmonitor", fsmonitor])[0] != 0:
+				return False
+		return True
+
 	def remoteUpdate(self, remote = None):
 		if remote:
 			result = self.__git__(["remote", "update", remote])
 		else:
 			result = self.__git__(["remote", "update"])
+		self.invalidate()
 		if result[0] == 0:
 			return True
 		return False
 
-	def clone(self, remote, mirror = False, bare = False, overwrite = False):
-		reference = hopper.utils.git.tasks.GitTask.getReference(remote, self.environment)
+	# A shared clone uses the objects of the (local) remote via alternates instead of
+	# copying them, the remote must never be pruned
+	def clone(self, remote, mirror = False, bare = False, overwrite = False,
+			depth = None, filter = None, branch = None, checkout = True, shared = False):
+		reference = None
+		if not shared:
+			reference = hopper.utils.git.tasks.GitTask.getReference(remote, self.environment)
 
 		args = ["clone"]
 		if bare and not mirror:
 			args.append("--bare")
 		if mirror:
 			args.append("--mirror")
+		if shared:
+			args.append("--shared")
 		if reference:
 			args.append("--no-hardlinks")
 			args.append("--reference")
 			args.append(reference)
+		if depth:
+			args.append("--depth")
+			args.append(str(depth))
+		if filter:
+			args.append("--filter=%s" % filter)
+		if branch:
+			args.append("--branch")
+			args.append(branch)
+		if not checkout:
+			args.append("--no-checkout")
 
 		args.append(remote)
 		args.append(self.path)
@@ -130,13 +239,207 @@ class Repository:
 				raise Exception("Repository or content already exists")
 
 		result = self.__git__(args)
+		self.invalidate(remotes = True)
 		if result[0] == 0:
 			return True
 		raise Exception("Clone failed - Exited %d, Output = %s" % (result[0], result[1]))
 
+	def isShallow(self):
+		gitdir = GitDirectory(self.path)
+		if gitdir.locate():
+			return os.path.exists(os.path.join(gitdir.commondir, "shallow"))
+		result = self.__git__(["rev-parse", "--is-shallow-repository"])
+		if result[0] == 0 and result[1].strip() == "true":
+			return True
+		return False
+
+	def fetch(self, remote, refspecs = None, depth = None, tags = True, prune = False):
+		args = ["fetch"]
+		if prune:
+			args.append("--prune")
+		if depth:
+			args.append("--depth")
+			args.append(str(depth))
+		if not tags:
+			args.append("--no-tags")
+		args.append(remote)
+		if refspecs:
+			args += refspecs
+
+		result = self.__git__(args)
+		self.invalidate()
+		if result[0] == 0:
+			return True
+		return False
+
+	# Fetch a single branch, tag or commit that is not available locally, the source
+	# can be used to fetch from a different location (e.g. a mirror) than the remote
+	def fetchRef(self, remote, ref, depth = None, source = None):
+		source = source or remote
+		if re.match("^[0-9a-f]{40}$", ref):
+			if self.fetch(source, [ref], depth, tags = False):
+				return True
+		else:
+			if self.fetch(source, ["+refs/heads/%s:refs/remotes/%s/%s" % (ref, remote, ref)], depth, tags = False):
+				# single branch clones need the branch added to be able to track it
+				self.addRemoteBranch(remote, ref)
+				return True
+			if self.fetch(source, ["+refs/tags/%s:refs/tags/%s" % (ref, ref)], depth, tags = False):
+				return True
+
+		# abbreviated commits cannot be fetched directly, fetch the missing history
+		if re.match("^[0-9a-f]{4,40}$", ref) and self.isShallow():
+			result = self.__git__(["fetch", "--unshallow", source])
+			self.invalidate()
+			if result[0] == 0:
+				return True
+		return False
+
+	def lsRemote(self, remote, patterns = None):
+		args = ["ls-remote", remote]
+		if patterns:
+			args += patterns
+
+		result = self.__git__(args)
+		if result[0] == 0:
+			refs = {}
+			for i in result[1].splitlines():
+				parts = i.split()
+				if len(parts) == 2:
+					refs[parts[1]] = parts[0]
+			return refs
+		return None
+
+	def fastForward(self, ref):
+		result = self.__git__(["merge", "--ff-only", ref])
+		self.invalidate()
+		if result[0] == 0:
+			return True
+		return False
+
+	def addWorktree(self, path, commit, checkout = True):
+		args = ["worktree", "add", "--detach"]
+		if not checkout:
+			args.append("--no-checkout")
+		result = self.__git__(args + [path, commit])
+		if result[0] == 0:
+			return True
+		return False
+
+	def pruneWorktrees(self):
+		result = self.__git__(["worktree", "prune"])
+		if result[0] == 0:
+			return True
+		return False
+
+	def createBundle(self, path, revisions):
+		result = self.__git__(["bundle", "create", path] + revisions)
+		if result[0] == 0:
+			return True
+		return False
+
+	# the refs contained in a bundle, refname -> commit
+	def listBundle(self, path):
+		result = self.__git__(["bundle", "list-heads", path])
+		if result[0] == 0:
+			refs = {}
+			for i in result[1].splitlines():
+				parts = i.split()
+				if len(parts) == 2:
+					refs[parts[1]] = parts[0]
+			return refs
+		return None
+
+	# incremental repack, only the loose objects are packed
+	def repack(self):
+		result = self.__git__(["repack", "-d", "-l", "-q"])
+		if result[0] == 0:
+			return True
+		return False
+
+	def packRefs(self):
+		result = self.__git__(["pack-refs", "--all"])
+		self.invalidate()
+		if result[0] == 0:
+			return True
+		return False
+
+	def writeCommitGraph(self):
+		result = self.__git__(["commit-graph", "write", "--reachable", "--split"])
+		if result[0] == 0:
+			return True
+		return False
+
+	def writeMultiPackIndex(self):
+		result = self.__git__(["multi-pack-index", "write"])
+		if result[0] == 0:
+			return True
+		return False
+
+	def prune(self, expire = "2.weeks.ago"):
+		result = self.__git__(["prune", "--expire", expire])
+		if result[0] == 0:
+			return True
+		return False
+
+	def getSparseCheckout(self):
+		directories = GitDirectory(self.path).readSparseCheckout()
+		if directories != None:
+			return directories
+
+		result = self.__git__(["sparse-checkout", "list"])
+		if result[0] == 0:
+			return sorted(result[1].splitlines())
+		return []
+
+	# Sets the directories of a cone mode sparse checkout, or disables sparse checkout
+	def setSparseCheckout(self, directories):
+		if directories:
+			result = self.__git__(["sparse-checkout", "set", "--cone"] + list(directories))
+		else:
+			result = self.__git__(["sparse-checkout", "disable"])
+		if result[0] == 0:
+			return True
+		return False
+
+	# populate the index and working tree of a repository cloned without checkout
+	def populate(self):
+		result = self.__git__(["read-tree", "-mu", "HEAD"])
+		self.invalidate()
+		if result[0] == 0:
+			return True
+		return False
+
+	def setConfig(self, key, value):
+		result = self.__git__(["config", key, value])
+		if result[0] == 0:
+			return True
+		return False
+
+	def setRemoteUrl(self, remote, url):
+		result = self.__git__(["remote", "set-url", remote, url])
+		self.invalidate(remotes = True)
+		if result[0] == 0:
+			return True
+		return False
+
+	def addRemoteBranch(self, remote, branch):
+		config = GitDirectory(self.path).readConfig()
+		if config != None:
+			refspecs = config.get(("remote", remote), {}).get("fetch", [])
+			if "+refs/heads/*:refs/remotes/%s/*" % remote in refspecs or \
+					"+refs/heads/%s:refs/remotes/%s/%s" % (branch, remote, branch) in refspecs:
+				return True
+
+		result = self.__git__(["remote", "set-branches", "--add", remote, branch])
+		if result[0] == 0:
+			return True
+		return False
+
 	def checkout(self, ref):
 		if ref:
 			result = self.__git__(["checkout", ref])
+			self.invalidate()
 			if result[0] == 0:
 				return True
 		return False
@@ -151,14 +454,9 @@ class Repository:
 		return None
 
 	def getTreeRef(self):
-		result = self.__git__(["rev-parse", "HEAD", "--symbolic-full-name", "HEAD"])
-		if result[0] == 0:
-			lines = result[1].splitlines()
-			sha = lines[0]
-			ref = lines[1]
-			if ref == "HEAD":
-				ref = None
-			return (ref, sha)
+		state = self.getRefState()
+		if state and state.head:
+			return state.head
 		return None
 
 	def getStatus(self):
@@ -184,31 +482,24 @@ class Repository:
 
 	def findRef(self, ref, remotename = None):
 		if ref:
-			fullref = None
-			if remotename:
-				result = self.__git__(["show-ref", "refs/remotes/%s/%s" % (remotename, ref)])
-				if result[0] == 0 and len(result[1]) != 0:
-					firstentry = result[1].splitlines()[0]
-					if len(firstentry) != 0:
-						fullref = firstentry.split()[1]
+			state = self.getRefState()
+			if state == None:
+				return None
 
-				if fullref:
+			if remotename:
+				fullref = "refs/remotes/%s/%s" % (remotename, ref)
+				if fullref in state.refs:
 					# find a local ref that tracks this ref
-					fullrefcommit = self.getRefCommit(fullref)
-					result = self.__git__(["for-each-ref", "--format=%(refname) %(upstream)", "refs/heads"])
-					if result[0] == 0:
-						for i in result[1].splitlines():
-							parts = i.split()
-							if parts[1] == fullref:
-								return (parts[0], None, fullrefcommit)
+					fullrefcommit = state.refs[fullref]
+					tracking = state.getTracking(fullref)
+					if tracking:
+						return (tracking, None, fullrefcommit)
 					return (fullref, None, fullrefcommit)
 
 			# local refs (and tags)
-			result = self.__git__(["rev-parse", "--symbolic-full-name", ref])
-			if result[0] == 0 and len(result[1]) != 0:
-				firstref = result[1].splitlines()[0]
-				if len(firstref) != 0:
-					return (firstref, None, self.getRefCommit(firstref))
+			fullref = state.resolve(ref)
+			if fullref:
+				return (fullref, None, self.getRefCommit(fullref))
 
 			# ref is a commit sha
 			sha = self.absoluteSHA(ref)
@@ -218,6 +509,10 @@ class Repository:
 
 	def shortRef(self, ref):
 		if ref:
+			state = self.getRefState()
+			if state and ref in state.refs:
+				return RefState.shortName(ref)
+
 			result = self.__git__(["rev-parse", "--abbrev-ref", ref])
 			if result[0] == 0 and len(result[1]) != 0:
 				firstentry = result[1].splitlines()[0]
@@ -226,28 +521,40 @@ class Repository:
 
 	def absoluteSHA(self, sha):
 		if sha:
-			result = self.__git__(["rev-parse", sha])
-			if result[0] == 0 and len(result[1]) != 0:
-				firstentry = result[1].splitlines()[0]
-				return firstentry
+			state = self.getRefState()
+			if state and GitDirectory.shapattern.match(sha):
+				# known to exist if it is the value of HEAD or any ref
+				if (state.head and state.head[1] == sha) or sha in state.refs.itervalues():
+					return sha
+
+			result = self.__query__(sha)
+			if result:
+				return result[0]
 		return None
 
 	def getRefs(self):
-		result = self.__git__(["show-ref"])
-		if result[0] == 0:
-			refs = []
-			for i in result[1].splitlines():
-				parts = i.split()
-				refs.append(parts[1])
-			return refs
+		state = self.getRefState()
+		if state:
+			return sorted(state.refs.iterkeys())
 		return None
 
 	def getRefCommit(self, ref):
-		result = self.__git__(["show-ref", ref])
-		if result[0] == 0:
-			for i in result[1].splitlines():
-				parts = i.split()
-				return parts[0]
+		state = self.getRefState()
+		if state:
+			return state.getCommit(ref)
+		return None
+
+	# the commit a ref points at, tags are peeled to their commit
+	def getPeeledCommit(self, ref):
+		state = self.getRefState()
+		if state:
+			if ref in state.peeled:
+				return state.peeled[ref]
+			if not ref.startswith("refs/tags/") and ref in state.refs:
+				return state.refs[ref]
+		result = self.__query__(ref + "^{commit}")
+		if result:
+			return result[0]
 		return None
 
 	def getCommitInfo(self, sha):
@@ -281,6 +588,13 @@ class Repository:
 		return None
 
 	def getRemotes(self):
+		if self.remotes != None:
+			return self.remotes
+
+		self.remotes = GitDirectory(self.path).getRemotes()
+		if self.remotes != None:
+			return self.remotes
+
 		result = self.__git__(["remote", "-v"])
 		if result[0] == 0:
 			remotes = {}
@@ -288,5 +602,6 @@ class Repository:
 				parts = i.split()
 				if parts[0] not in remotes:
 					remotes[parts[0]] = parts[1]
+			self.remotes = remotes
 			return remotes
 		return None
@@ -22,6 +22,8 @@
 import os
 import urlparse
 import shutil
+import subprocess
+import threading
 
 from hopper.utils.logger import *
 import hopper.utils.process
@@ -79,9 +81,65 @@ class GitTask(hopper.utils.process.Process):
 			reference = environment.getSourceMirror()
 			referenceargs = []
 			if reference != None:
+				# managed mirror of the remote
+				from hopper.utils.git.mirror import MirrorStore
+				managed = MirrorStore(environment).getMirrorPath(remote)
+				if os.path.exists(managed):
+					return managed
 				if os.path.exists(os.path.join(reference, clonename + ".git")):
 					return os.path.join(reference, clonename + ".git")
 				if os.path.exists(os.path.join(reference, clonename)):
 					return os.path.join(reference, clonename)
 		return None
 
+# A long running 'git cat-file --batch-check' process, allows many object names
+# to be resolved against a repository without forking git for each lookup
+class GitObjectQuery(GitTask):
+	def __init__(self, environment, path = None):
+		GitTask.__init__(self, environment, ["cat-file", "--batch-check"], path)
+		self.process = None
+		self.lock = threading.RLock()
+
+	def start(self):
+		with self.lock:
+			if self.process and self.process.poll() == None:
+				return True
+			commandargs = self.getArgs()
+			self.logger().debug("process: created '%s' (batch)" % commandargs)
+			with open(os.devnull, "w") as devnull:
+				self.process = subprocess.Popen(commandargs,
+						stdin = subprocess.PIPE,
+						stdout = subprocess.PIPE,
+						stderr = devnull,
+						cwd = self.workingDirectory,
+						env = self.getEnvironment())
+			return True
+
+	def query(self, name):
+		if not name or "\n" in name:
+			return None
+		with self.lock:
+			self.start()
+			try:
+				self.process.stdin.write(name + "\n")
+				self.process.stdin.flush()
+				line = self.process.stdout.readline()
+			except IOError:
+				self.close()
+				return None
+
+		# '<sha> <type> <size>' or '<name> missing'
+		parts = line.split()
+		if len(parts) == 3 and parts[1] not in ["missing", "ambiguous"]:
+			return (parts[0], parts[1])
+		return None
+
+	def close(self):
+		with self.lock:
+			if self.process:
+				try:
+					self.process.stdin.close()
+					self.process.wait()
+				except (IOError, OSError):
+					pass
+				self.process = None
@@ -20,29 +20,133 @@
 
 
 import os
+import re
 import urlparse
 import shutil
 import datetime
+import time
+import socket
 
 from hopper.utils.logger import *
 import hopper.utils.git.tasks
 import hopper.utils.git.repo
+import hopper.utils.git.mirror
 import hopper.source.meta
+import hopper.utils.tasks
 import threading
 
 class Watcher:
+	# Queries a remote for the state of only the refs that are watched
+	class RemoteQueryTask(hopper.utils.tasks.TaskBase):
+		def __init__(self, environment, remote, refs):
+			hopper.utils.tasks.TaskBase.__init__(self, environment)
+			self.remote = remote
+			self.refs = refs
+			self.error = None
+
+		def __repr__(self):
+			return "Query '%s'" % self.remote
+
+		def execute(self, handler = None):
+			self.environment.log("Grabbing refs from remote for %s" % self.remote)
+			result = hopper.utils.git.tasks.GitTask.run(["ls-remote", self.remote] + self.refs, environment = self.environment)
+			if result[0] != 0:
+				self.error = result[1]
+				return None
+
+			refs = {}
+			for r in result[1].splitlines():
+				parts = r.split()
+				if len(parts) == 2:
+					refs[parts[1]] = parts[0]
+			self.environment.debug("got refs -> %s" % repr(refs))
+			return refs
+
+	# Fetches the watched refs into the managed mirror and reads their state from the
+	# mirror, the objects are then already available locally for the build
+	class MirrorQueryTask(RemoteQueryTask):
+		def __repr__(self):
+			return "Mirror Fetch '%s'" % self.remote
+
+		def execute(self, handler = None):
+			self.environment.log("Fetching refs into mirror for %s" % self.remote)
+			mirror = hopper.utils.git.mirror.MirrorStore(self.environment)
+			try:
+				path = mirror.update(self.remote, self.refs)
+			except Exception as e:
+				self.error = str(e)
+				return None
+			if not path:
+				self.error = "Mirror is not available"
+				return None
+
+			repo = mirror.getRepository(self.remote)
+			state = repo.getRefState()
+			repo.close()
+			if state == None:
+				self.error = "Unable to read refs of mirror '%s'" % path
+				return None
+
+			refs = {}
+			for i in self.refs:
+				if i in state.refs:
+					refs[i] = state.refs[i]
+			self.environment.debug("got refs -> %s" % repr(refs))
+			return refs
+
+	# A pending change of a group, consecutive changes are merged into the newest pin.
+	# The ranges record the commits of each changed ref as (before, newest), the
+	# commits between them have been skipped.
+	class Change:
+		def __init__(self, layers, pinned, ranges):
+			self.layers = layers
+			self.pinned = pinned
+			self.ranges = ranges
+			self.time = datetime.datetime.utcnow()
+			self.first = self.time
+			self.coalesced = 0
+
+		def merge(self, older):
+			for i in older.ranges.iteritems():
+				if i[0] in self.ranges:
+					self.ranges[i[0]] = (i[1][0], self.ranges[i[0]][1])
+				else:
+					self.ranges[i[0]] = i[1]
+			self.first = older.first
+			self.coalesced += older.coalesced + 1
+
 	class GroupState:
 		def __init__(self, layers):
 			self.layers = layers
 			self.refstate = {}
+			self.previousrefstate = {}
+
+			# at most one change is pending, keeping the memory used bounded
+			self.pending = None
+			self.seen = 0
+			self.coalesced = 0
+			self.consumed = 0
+
+		# The remote branch watched for a layer ref, commits and other refs (e.g. tags)
+		# are not expected to change and are not watched
+		@staticmethod
+		def getWatchedRef(ref):
+			if not ref or re.match("^[0-9a-f]{40}$", ref):
+				return None
+			if ref.startswith("refs/heads/"):
+				return ref
+			if ref.startswith("refs/"):
+				return None
+			return "refs/heads/" + ref
 
 		def getRefPairs(self):
 			pairs = []
 			for i in self.layers:
 				if i.source and isinstance(i.source, hopper.source.meta.GitSource):
 					if i.source.canFetch():
-						# TODO: handle ref/tag/commit properly below
-						pairs.append((i.source.remote, "refs/heads/" + i.source.ref))
+						refname = Watcher.GroupState.getWatchedRef(i.source.ref)
+						if refname:
+							pairs.append((i.source.remote, refname))
 			return pairs
 
 		def filterPairs(self, remoterefs):
@@ -79,58 +183,116 @@ class Watcher:
 								if newrefstate[i[0]][i[1]] != oldrefstate[i[0]][i[1]]:
 									changed = True
 
+			self.previousrefstate = oldrefstate
 			self.refstate = newrefstate
 			return changed
 
+		def push(self, pinned):
+			ranges = {}
+			for remote in self.refstate.iteritems():
+				for ref in remote[1].iteritems():
+					old = self.previousrefstate.get(remote[0], {}).get(ref[0])
+					if old != ref[1]:
+						ranges[(remote[0], ref[0])] = (old, ref[1])
+
+			change = Watcher.Change(self.layers, pinned, ranges)
+			self.seen += 1
+			if self.pending:
+				change.merge(self.pending)
+				self.coalesced += 1
+			self.pending = change
+
+		def pop(self):
+			change = self.pending
+			if change:
+				self.pending = None
+				self.consumed += 1
+			return change
+
 		def cloneRefPin(self, remoterefs):
 			filtered = self.filterPairs(remoterefs)
 
-			# create layers that match the layers object, fill in pinned refs
-			pinnedlayers = hopper.source.meta.LayerCollection(self.layers.defaultversion)
+			# copy on write clone of the layers, only the git sources are replaced by the pinned refs
+			pinnedlayers = self.layers.clone()
 			for i in self.layers:
 				if isinstance(i.source, hopper.source.meta.GitSource):
-					# TODO: fixup pciking of ref name
-					refname = "refs/heads/" + i.source.ref
+					refname = Watcher.GroupState.getWatchedRef(i.source.ref)
 					refpin = None
-					if i.source.remote in filtered:
-						refs = filtered[i.source.remote]
-						if refname in refs:
-							refpin = refs[refname]
-					newsource = hopper.source.meta.GitSource(i.source.remote, refpin)
-				else:
-					newsource = i.source
-				pinnedlayers.add(i.getFullName(), newsource)
+					if refname and i.source.remote in filtered:
+						refpin = filtered[i.source.remote].get(refname)
+					if refpin:
+						pinnedlayers.setSource(i, hopper.source.meta.GitSource(i.source.remote, refpin))
+					elif refname:
+						# e.g. the branch was deleted/renamed or is a tag, the ref is resolved when fetching
+						warning("Unable to pin '%s' of '%s', using the ref unpinned" % (refname, i.source.remote))
 			return pinnedlayers
 
-	def __init__(self, environment):
+	def __init__(self, environment, jobs = None):
 		self.environment = environment
-		self.stop = threading.Event()
+		self.stopped = threading.Event()
+		self.nudged = threading.Event()
 		self.thread = None
 		self.interval = 0
 
+		# fetch into the mirror instead of querying the remotes
+		self.usemirror = False
+		# external nudges to check immediately, a touched file or a local socket
+		self.triggerfile = None
+		self.triggerpoll = 1
+		self.socketpath = None
+		self.listener = None
+
+		# number of remotes queried concurrently
+		self.jobs = jobs
+		# remote -> (consecutive failures, time of next query)
+		self.backoff = {}
+		self.maxbackoff = 600
+
 		self.lock = threading.RLock()
+		self.checklock = threading.Lock()
 		self.groups = []
 
 		self.changeevent = threading.Condition()
-		self.changequeue = []
 
 	def addLayers(self, layers):
 		group = Watcher.GroupState(layers)
-		self.groups.append(group)
+		with self.lock:
+			self.groups.append(group)
 
 	def start(self, interval = 30):
 		if self.thread and self.thread.isAlive():
 			return
 
 		self.interval = interval
+		self.stopped.clear()
+		if self.socketpath:
+			self.listener = threading.Thread(target = self.__listen__)
+			self.listener.daemon = True
+			self.listener.start()
 		self.thread = threading.Thread(target = self.__worker__)
-		self.daemon = True
+		self.thread.daemon = True
 		self.thread.start()
 
 	def stop(self):
 		if self.thread and self.thread.isAlive():
-			self.stop.set()
+			self.stopped.set()
+			self.nudged.set()
 			self.thread.join()
+		if self.listener and self.listener.isAlive():
+			self.listener.join()
+
+	# request a check as soon as possible (from any thread)
+	def nudge(self):
+		self.nudged.set()
+
+	@staticmethod
+	def sendNudge(socketpath):
+		client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			client.connect(socketpath)
+			client.sendall("check\n")
+		finally:
+			client.close()
 
 	def alive(self):
 		if self.thread and self.thread.isAlive():
@@ -140,65 +302,163 @@ class Watcher:
 	def trigger(self):
 		self.__check__(True)
 
+	# Checks are serialized (checklock), the state is only locked while the groups are
+	# read and updated, not while the remotes are queried
 	def __check__(self, trigger = False):
-		with self.lock:
-			haschanges = False
+		with self.checklock:
+			with self.lock:
+				groups = list(self.groups)
 
-			remotes = []
-			for i in self.groups:
+			remotes = {}
+			for i in groups:
 				for p in i.getRefPairs():
-					if p[0] not in remotes:
-						remotes.append(p[0])
-
-			self.environment.debug("need to update for the following remotes -> %s" % remotes)
-
-			refstate = {}
-			for i in remotes:
-				self.environment.log("Grabbing refs from remote for %s" % i)
-				result = hopper.utils.git.tasks.GitTask.run(["ls-remote", i], environment = self.environment)
-				if result[0] == 0:
-					refstate[i] = {}
-					for r in result[1].splitlines():
-						parts = r.split()
-						refstate[i][parts[1]] = parts[0]
-					self.environment.debug("got refs -> %s" % repr(refstate[i]))
-				else:
-					self.environment.error("Failed to get remote state for '%s' error message = %s" % (i, result[1]))
-					return
+					refs = remotes.setdefault(p[0], [])
+					if p[1] not in refs:
+						refs.append(p[1])
+
+			self.environment.debug("need to update for the following remotes -> %s" % remotes.keys())
+
+			refstate = self.__query__(remotes, trigger)
 
 			haschanges = False
-			for i in self.groups:
-				if i.update(refstate, trigger):
-					self.environment.log("Changes have happened since last check, pinning")
-					changes = i.cloneRefPin(refstate)
-					self.changequeue.append((i.layers, changes, datetime.datetime.utcnow()))
-					haschanges = True
+			with self.lock:
+				for i in groups:
+					# groups are only updated once the state of all their remotes is known
+					missing = [p[0] for p in i.getRefPairs() if p[0] not in refstate]
+					if len(missing) != 0:
+						self.environment.debug("skipping group update, no remote state for %s" % missing)
+						continue
+
+					if i.update(refstate, trigger):
+						self.environment.log("Changes have happened since last check, pinning")
+						i.push(i.cloneRefPin(refstate))
+						haschanges = True
 
 		if haschanges:
 			with self.changeevent:
 				self.changeevent.notifyAll()
 
-	def __worker__(self):
-		while not self.stop.wait(self.interval):
-			self.__check__()
+	# Query the remotes concurrently, remotes which have failed are backed off and
+	# are not queried until their backoff expires (or the check is triggered)
+	def __query__(self, remotes, trigger = False):
+		now = time.time()
+		executor = hopper.utils.tasks.TaskExecutor(self.environment, self.jobs, failfast = False)
+		querytask = Watcher.MirrorQueryTask if self.usemirror else Watcher.RemoteQueryTask
+		for i in sorted(remotes.iterkeys()):
+			if not trigger and i in self.backoff and self.backoff[i][1] > now:
+				self.environment.debug("backing off remote '%s'" % i)
+				continue
+			executor.add(querytask(self.environment, i, remotes[i]))
+
+		refstate = {}
+		for task, result in zip(executor.tasks, executor.execute()):
+			if result != None:
+				refstate[task.remote] = result
+				if task.remote in self.backoff:
+					del self.backoff[task.remote]
+			else:
+				failures = self.backoff.get(task.remote, (0, 0))[0] + 1
+				delay = min(max(self.interval, 1) * (2 ** failures), self.maxbackoff)
+				self.backoff[task.remote] = (failures, now + delay)
+				self.environment.error("Failed to get remote state for '%s' error message = %s" % (task.remote, task.error))
+				self.environment.warning("Backing off remote '%s' for %d seconds" % (task.remote, delay))
+		return refstate
+
+	def __getTriggerTime__(self):
+		if self.triggerfile:
+			try:
+				return os.stat(self.triggerfile).st_mtime
+			except OSError:
+				pass
+		return None
 
-	def wait(self):
+	def __worker__(self):
+		triggertime = self.__getTriggerTime__()
+		nextcheck = time.time() + self.interval
+		while not self.stopped.isSet():
+			timeout = max(0, nextcheck - time.time())
+			if self.triggerfile:
+				timeout = min(timeout, self.triggerpoll)
+			self.nudged.wait(timeout)
+			if self.stopped.isSet():
+				break
+
+			check = False
+			if self.nudged.isSet():
+				self.environment.debug("nudged, checking for changes")
+				check = True
+			newtriggertime = self.__getTriggerTime__()
+			if newtriggertime != triggertime:
+				self.environment.debug("trigger file '%s' touched, checking for changes" % self.triggerfile)
+				triggertime = newtriggertime
+				check = True
+
+			if check or time.time() >= nextcheck:
+				self.nudged.clear()
+				self.__check__()
+				nextcheck = time.time() + self.interval
+
+	# accepts connections on a local socket, each connection nudges the watcher
+	def __listen__(self):
+		if os.path.exists(self.socketpath):
+			os.remove(self.socketpath)
+		server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		server.bind(self.socketpath)
+		server.listen(5)
+		server.settimeout(1)
+		try:
+			while not self.stopped.isSet():
+				try:
+					connection = server.accept()[0]
+				except socket.timeout:
+					continue
+				try:
+					connection.settimeout(1)
+					connection.recv(1024)
+				except socket.error:
+					pass
+				finally:
+					connection.close()
+				self.nudge()
+		finally:
+			server.close()
+			if os.path.exists(self.socketpath):
+				os.remove(self.socketpath)
+
+	def wait(self, timeout = None):
 		if self.alive():
-			if self.hasnext():
-				return
-
 			with self.changeevent:
-				self.changeevent.wait()
+				if self.hasnext():
+					return
+				self.changeevent.wait(timeout)
 
 	def hasnext(self):
+		return self.peek() != None
+
+	# the pending change which has been waiting the longest (without consuming it)
+	def peek(self):
 		with self.lock:
-			if len(self.changequeue) != 0:
-				return True
-		return False
+			oldest = None
+			for i in self.groups:
+				if i.pending and (oldest == None or i.pending.first < oldest.first):
+					oldest = i.pending
+			return oldest
 
 	def getnext(self):
 		with self.lock:
-			if len(self.changequeue) != 0:
-				return self.changequeue.pop()
+			change = self.peek()
+			if change:
+				for i in self.groups:
+					if i.pending is change:
+						return i.pop()
 		return None
 
+	def getCounters(self):
+		with self.lock:
+			counters = {"seen" : 0, "coalesced" : 0, "consumed" : 0}
+			for i in self.groups:
+				counters["seen"] += i.seen
+				counters["coalesced"] += i.coalesced
+				counters["consumed"] += i.consumed
+			return counters
+
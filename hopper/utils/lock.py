@@ -0,0 +1,72 @@
+# Copyright (c) 2015 Xilinx Inc.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import fcntl
+import errno
+
+from hopper.utils.logger import *
+
+# Advisory lock on a file, used to serialize access to shared resources (e.g.
+# mirrors) between concurrent hopper processes
+class FileLock:
+	def __init__(self, path, shared = False):
+		self.path = path
+		self.shared = shared
+		self.file = None
+
+	def acquire(self, blocking = True):
+		if self.file:
+			return True
+
+		if not os.path.exists(os.path.dirname(self.path)):
+			os.makedirs(os.path.dirname(self.path))
+
+		self.file = open(self.path, "a")
+		mode = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+		try:
+			fcntl.flock(self.file.fileno(), mode | fcntl.LOCK_NB)
+			return True
+		except IOError as e:
+			if e.errno not in [errno.EAGAIN, errno.EACCES]:
+				raise
+
+		if not blocking:
+			self.file.close()
+			self.file = None
+			return False
+
+		debug("Waiting for lock '%s'" % self.path)
+		fcntl.flock(self.file.fileno(), mode)
+		return True
+
+	def release(self):
+		if self.file:
+			fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+			self.file.close()
+			self.file = None
+
+	def __enter__(self):
+		self.acquire()
+		return self
+
+	def __exit__(self, type, value, traceback):
+		self.release()
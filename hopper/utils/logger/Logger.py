@@ -170,3 +170,23 @@ class MassLogger(Logger):
 					for l in self.loggers:
 						l[0].log(i, level, severity)
 
+# Collects log messages so that they can be written to another logger as a group
+class BufferedLogger(Logger):
+	def __init__(self, logger):
+		Logger.__init__(self)
+		self.logger = logger
+		self.records = []
+		self.recordslock = threading.RLock()
+
+	def log(self, message, level = LoggerLevel.Normal, severity = LoggerSeverity.Info):
+		with self.recordslock:
+			self.records.append((message, level, severity))
+
+	def flush(self):
+		with self.recordslock:
+			records = self.records
+			self.records = []
+		if self.logger:
+			for i in records:
+				self.logger.log(i[0], i[1], i[2])
+
@@ -81,6 +81,12 @@ class BuildToolsHelper:
 
 		return None
 
+	@staticmethod
+	def isInstalled(buildtoolspath):
+		if os.path.isdir(buildtoolspath) and len(os.listdir(buildtoolspath)) != 0:
+			return True
+		return False
+
 # This task prepares and expands a buildtools tarball
 class BuildToolsTask(hopper.utils.tasks.TaskBase):
 	def __init__(self, environment):
@@ -98,8 +104,7 @@ class BuildToolsTask(hopper.utils.tasks.TaskBase):
 		if downloadUrl == None:
 			raise Exception("Unable to find a valid build tools download for you system.")
 
-		if os.path.isdir(self.environment.getWorkingToolsPath()) and \
-				len(os.listdir(self.environment.getWorkingToolsPath())) != 0:
+		if BuildToolsHelper.isInstalled(self.environment.getWorkingToolsPath()):
 			self.environment.note("Build tools already populated, skipping install step")
 			return True
 
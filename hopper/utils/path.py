@@ -38,3 +38,10 @@ def switchrelpath(path, root, newroot):
 		return os.path.join(newroot, relpath)
 	else:
 		return path
+
+# Replace the file atomically (readers never see a partially written file)
+def writeatomic(path, data):
+	temppath = "%s.%d.tmp" % (path, os.getpid())
+	with open(temppath, "w") as f:
+		f.write(data)
+	os.rename(temppath, path)
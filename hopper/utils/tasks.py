@@ -20,6 +20,9 @@
 
 import os, sys
 import urllib2
+import copy
+import threading
+import traceback
 
 from hopper.utils.logger import *
 
@@ -33,6 +36,110 @@ class TaskBase:
 				return False
 		return True
 
+class TaskExecutionException(Exception):
+	def __init__(self, failures):
+		self.failures = failures
+		message = "%d task(s) failed:" % len(failures)
+		for i in failures:
+			message += "\n    * %s: %s" % (i[0], i[1])
+		Exception.__init__(self, message)
+
+# Executes independent tasks concurrently using a pool of worker threads, the
+# output of each task is buffered and logged as one group when the task completes.
+class TaskExecutor:
+	def __init__(self, environment, jobs = None, failfast = True):
+		self.environment = environment
+		self.jobs = jobs
+		self.failfast = failfast
+		self.tasks = []
+
+		self.lock = threading.Condition()
+		self.outputlock = threading.RLock()
+
+	def add(self, task):
+		self.tasks.append(task)
+
+	def getJobs(self):
+		jobs = self.jobs
+		if not jobs and self.environment:
+			jobs = self.environment.getMaxThreads()
+		if not jobs:
+			jobs = 1
+		return max(1, min(int(jobs), len(self.tasks)))
+
+	def execute(self, handler = None):
+		if len(self.tasks) == 0:
+			return []
+
+		pending = list(enumerate(self.tasks))
+		results = [None] * len(self.tasks)
+		failures = []
+		state = {"active" : 0}
+
+		def worker():
+			try:
+				while True:
+					with self.lock:
+						if len(pending) == 0:
+							return
+						index, task = pending.pop(0)
+
+					try:
+						result = self.__run__(task, handler)
+					except BaseException as e:
+						# failures outside of the task (e.g. flushing the output) or exits
+						result = (None, e)
+
+					with self.lock:
+						if result[1] != None:
+							failures.append((task, result[1]))
+							if self.failfast:
+								# do not start any more tasks, running tasks are allowed to complete
+								del pending[:]
+						else:
+							results[index] = result[0]
+			finally:
+				# the executor waits for all workers, even if one has died
+				with self.lock:
+					state["active"] -= 1
+					self.lock.notifyAll()
+
+		jobs = self.getJobs()
+		if self.environment:
+			self.environment.debug("Executing %d tasks with %d workers" % (len(self.tasks), jobs))
+
+		with self.lock:
+			for i in range(0, jobs):
+				thread = threading.Thread(target = worker)
+				thread.daemon = True
+				state["active"] += 1
+				thread.start()
+
+			while state["active"] != 0:
+				# wait with a timeout so that KeyboardInterrupt can be received
+				self.lock.wait(1)
+
+		if len(failures) != 0:
+			raise TaskExecutionException(failures)
+		return results
+
+	def __run__(self, task, handler = None):
+		buffered = None
+		if task.environment:
+			buffered = BufferedLogger(task.environment.getLogger())
+			task.environment = task.environment.clone(logger = buffered)
+
+		try:
+			return (task.execute(handler), None)
+		except Exception as e:
+			if buffered:
+				task.environment.debug(traceback.format_exc())
+			return (None, e)
+		finally:
+			if buffered:
+				with self.outputlock:
+					buffered.flush()
+
 class Environment:
 	def __init__(self, basepath = os.getcwd(),
 				logger = None, mirrorpath = None, proxy = None,
@@ -45,6 +152,15 @@ class Environment:
 		self.logger = logger
 
 		self.allowbuildtools = True
+		# the mirrors refreshed by the current invocation (shared by the clones), None
+		# if not tracked (mirrors are refreshed whenever requested)
+		self.refreshedmirrors = None
+
+	def clone(self, logger = None):
+		environment = copy.copy(self)
+		if logger:
+			environment.logger = logger
+		return environment
 
 	def getMirrorPath(self):
 		return self.mirrorpath